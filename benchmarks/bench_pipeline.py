@@ -0,0 +1,266 @@
+"""
+End-to-end benchmarks of the clipboard-to-translation pipeline.
+
+`main_loop` runs on a fake clipboard with the local "mock" engine and the Youdao engine pointed at a local stand-in,
+so that no network access or API key is needed. Lines are copied one after another, each after the previous one has
+all its results, and a line is copied again with the given repetition rate. MeCab must be installed as for any other
+run, and "cp2trans/config.ini" must exist.
+
+    python benchmarks/bench_pipeline.py [-n lines] [-r repetition] [-l 10000,100000,1000000] [-m entries]
+                                        [-o result.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ARGV, sys.argv[1:] = sys.argv[1:], []  # cp2trans parses the command line when imported.
+from cp2trans import cp2trans  # noqa: E402
+
+cp2trans.logger.setLevel(cp2trans.logging.WARNING)
+
+# Fragments of TEST_STRING-like news and game text, joined into lines of realistic length.
+FRAGMENTS = (
+    '8月3日に放送された', '「中居正広の金曜日のスマイルたちへ」(TBS系)で、', '1日たった5分で',
+    'ぽっこりおなかを解消するという', 'ダイエット方法を紹介。', 'キンタロー。のダイエットにも密着。',
+    '今日はいい天気ですね。', 'ちょっと待ってください、', 'あの人は誰だったのかしら。', 'もう二度と会えないと思っていた。',
+    '扉の向こうから声が聞こえる。', '明日の朝、駅の前で待っています。', 'それは本当に君の選んだ道なのか？',
+    '静かな夜に雨の音だけが響いていた。', '東京都の新しい条例が来月から施行される。', '猫は窓辺で眠っている。',
+)
+ENGINES = 'youdao,mock'
+TARGETS = 'zh-CHS,en'
+
+
+def corpus(count, repetition, seed=0):
+    # `repetition` of the lines are copies of earlier ones, but never of the line right before (the clipboard would
+    # not change).
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < count:
+        if lines and rng.random() < repetition:
+            line = rng.choice(lines)
+        else:
+            line = ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 4)))
+        if not lines or line != lines[-1]:
+            lines.append(line)
+    return lines
+
+
+def summarize(values):
+    values = sorted(values)
+    return {'count': len(values), 'mean': sum(values) / len(values) if values else None,
+            'p50': cp2trans.percentile(values, 50), 'p95': cp2trans.percentile(values, 95),
+            'p99': cp2trans.percentile(values, 99), 'max': values[-1] if values else None}
+
+
+class Recorder:
+    """
+    Stand-in for sys.stdout, which timestamps the first engine result and the closing line of each paste.
+    """
+
+    def __init__(self, engines):
+        # Titles of results from the log end with "(from log)" or "(from log, 95% match)".
+        self._titles = {cp2trans.DIVIDING_TITLE.format(name.upper()) for name in engines}
+        head = cp2trans.DIVIDING_TITLE[:cp2trans.DIVIDING_TITLE.index('{}')]
+        self._prefixes = tuple(head + name.upper() + ' (from log' for name in engines)
+        self._buffer = ''
+        self._result_next = False
+        self.first = None
+        self.done = threading.Event()
+
+    def reset(self):
+        self.first = None
+        self.done.clear()
+
+    def write(self, text):
+        self._buffer += text
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            if self._result_next and self.first is None:
+                self.first = time.perf_counter()
+            self._result_next = line in self._titles or line.startswith(self._prefixes)
+            if line == cp2trans.DIVIDING_LINE:
+                self.done.set()
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def bench_pipeline(lines, concurrent, latency, directory):
+    options = cp2trans.config['global']
+    options['mock_latency'] = str(latency)
+    stand_in = cp2trans.YoudaoStandIn(latency=latency)
+    options['youdao_api'] = stand_in.start()
+    args = ['--log', os.path.join(directory, 'pipeline{}.db'.format(int(concurrent))), '--engines', ENGINES,
+            '--target', TARGETS] + (['--concurrent'] if concurrent else [])
+    profile = cp2trans.create_profile(cp2trans.parser.parse_args(args))
+    clipboard = cp2trans.FakeClipboard()
+    recorder = Recorder(profile.engines)
+    stdout, sys.stdout = sys.stdout, recorder
+    threading.Thread(target=cp2trans.main_loop, args=(profile, cp2trans.create_watcher(profile, clipboard)),
+                     daemon=True).start()
+    first, done = [], []
+    tracemalloc.start()
+    try:
+        for line in lines:
+            recorder.reset()
+            start = time.perf_counter()
+            clipboard.copy(line)
+            recorder.done.wait()
+            done.append(time.perf_counter() - start)
+            if recorder.first is not None:
+                first.append(recorder.first - start)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        sys.stdout = stdout
+        stand_in.stop()
+    return {'first_result': summarize(first), 'all_results': summarize(done), 'peak_traced_bytes': peak,
+            'engines': {name: engine.stats() for name, engine in profile.engines.items()}}
+
+
+def bench_morphology(lines):
+    import romkan
+    lines = list(set(lines))
+    chars = sum(len(line) for line in lines)
+    start = time.perf_counter()
+    sentences = [cp2trans._tokenize(line) for line in lines]  # Uncached.
+    mecab = time.perf_counter() - start
+    readings = [reading for sentence in sentences for reading in sentence.readings]
+    start = time.perf_counter()
+    for reading in readings:
+        romkan.to_roma(reading)
+    roma = time.perf_counter() - start
+    return {'lines': len(lines), 'chars': chars, 'mecab_us_per_char': mecab / chars * 1e6,
+            'romkan_us_per_char': roma / sum(len(reading) for reading in readings) * 1e6}
+
+
+def bench_log(size, lookups, directory, fuzzy=False):
+    filename = os.path.join(directory, 'log{}.db'.format(size))
+    # Saved entries stay buffered until the flush below, which then writes all of them.
+    log = cp2trans.LogStore(filename, fuzzy, flush_interval=3600, flush_entries=lookups + 1)
+    entry = {'source': 'ソース', 'romkan': 'so-su', 'youdao': '来源', 'aws': 'Source', 'google': '来源'}
+    start = time.perf_counter()
+    for offset in range(0, size, 10000):
+        log.update({'line{}'.format(i): entry for i in range(offset, min(offset + 10000, size))})
+    build = time.perf_counter() - start
+    rng = random.Random(size)
+    keys = ['line{}'.format(rng.randrange(size * 2)) for _ in range(lookups)]  # About half of them miss.
+    periods = []
+    for key in keys:
+        start = time.perf_counter()
+        log.get(key)
+        periods.append(time.perf_counter() - start)
+    lookup = summarize(periods)
+    fuzzy_lookup = None
+    if fuzzy:
+        periods = []
+        for key in keys:
+            start = time.perf_counter()
+            log.fuzzy_get(key + '！', 0.9)
+            periods.append(time.perf_counter() - start)
+        fuzzy_lookup = summarize(periods)
+    # Setting an entry only buffers it, the disk is written by the flush, timed on its own.
+    periods = []
+    saves = min(lookups, 1000)
+    for i in range(saves):
+        start = time.perf_counter()
+        log['new{}'.format(i)] = entry
+        periods.append(time.perf_counter() - start)
+    save = summarize(periods)
+    start = time.perf_counter()
+    log.flush()
+    flush = time.perf_counter() - start
+    flush_stats = log.stats()
+    log.close()
+    return {'entries': size, 'build_seconds': build, 'file_bytes': os.path.getsize(filename), 'lookup': lookup,
+            'fuzzy_lookup': fuzzy_lookup, 'save': save, 'flush_seconds': flush, 'flush_per_entry': flush / saves,
+            'flush_stats': flush_stats}
+
+
+def bench_memory(count, directory):
+    # Bytes per entry of tokenized sentences held in the cache, of the log loaded as the dict of dicts it used to be,
+    # and of log records on disk.
+    lines = list(dict.fromkeys(corpus(count * 4, 0, seed=1)))[:count]
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    sentences = [cp2trans._tokenize(line) for line in lines]
+    for sentence in sentences:
+        sentence.romkan  # Held in the cache along with the morphemes.
+    sentence_bytes = tracemalloc.get_traced_memory()[0] - start
+    text = json.dumps({line: {'source': sentence.source, 'romkan': sentence.romkan, 'youdao': '[zh-CHS] ' + line,
+                              'aws': '[en] ' + line, 'google': None} for line, sentence in zip(lines, sentences)})
+    del sentences
+    start = tracemalloc.get_traced_memory()[0]
+    log = json.loads(text)
+    dict_bytes = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    results = {'entries': len(lines), 'sentence_cache': sentence_bytes / len(lines),
+               'dict_log': dict_bytes / len(lines)}
+    for name, store in (('log_file', cp2trans.LogStore), ('encrypted_log_file', cp2trans.EncryptedLogStore)):
+        filename = os.path.join(directory, name + '.db')
+        store = store(filename) if store is cp2trans.LogStore else store(filename, 'password')
+        store.update(log)
+        store.close()
+        results[name] = os.path.getsize(filename) / len(lines)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cp2trans clipboard-to-translation pipeline.')
+    parser.add_argument('-n', '--lines', type=int, default=200, help='Number of lines copied.')
+    parser.add_argument('-r', '--repetition', type=float, default=0.3, help='Rate of lines copied again.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean latency of the engines in seconds.')
+    parser.add_argument('-l', '--log-sizes', default='10000,100000,1000000', help='Log sizes, separated by comma.')
+    parser.add_argument('--lookups', type=int, default=10000, help='Number of log lookups at each size.')
+    parser.add_argument('--fuzzy', action='store_true', help='Build the fuzzy index and measure fuzzy lookups.')
+    parser.add_argument('-m', '--memory-entries', type=int, default=10000,
+                        help='Number of distinct entries to measure memory per entry with.')
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+    args = parser.parse_args(ARGV)
+    lines = corpus(args.lines, args.repetition)
+    results = {'python': sys.version.split()[0], 'lines': len(lines), 'repetition': args.repetition,
+               'latency': args.latency}
+    with tempfile.TemporaryDirectory() as directory:
+        results['morphology'] = bench_morphology(lines)
+        results['memory'] = bench_memory(args.memory_entries, directory)
+        results['sequential'] = bench_pipeline(lines, False, args.latency, directory)
+        results['concurrent'] = bench_pipeline(lines, True, args.latency, directory)
+        results['log'] = [bench_log(int(size), args.lookups, directory, args.fuzzy) for size in args.log_sizes.split(',')]
+    results['stages'] = json.loads(cp2trans.metrics.to_json())
+    try:
+        import resource
+        results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass  # Windows
+    print('mecab {:.2f}us/char  romkan {:.2f}us/char'.format(results['morphology']['mecab_us_per_char'],
+                                                            results['morphology']['romkan_us_per_char']))
+    print('bytes per entry: sentence cache {sentence_cache:.0f}  dict log {dict_log:.0f}  log file {log_file:.0f}  '
+          'encrypted log file {encrypted_log_file:.0f}'.format(**results['memory']))
+    for mode in ('sequential', 'concurrent'):
+        for stage in ('first_result', 'all_results'):
+            stats = results[mode][stage]
+            print('{:<11} {:<13} p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s'.format(mode, stage, stats['p50'],
+                                                                              stats['p95'], stats['p99']))
+    for log in results['log']:
+        print('log {:<8} lookup p50 {:.1f}us p99 {:.1f}us  save p50 {:.1f}us p99 {:.1f}us  flush {:.1f}us/entry  '
+              '{} bytes'.format(log['entries'], log['lookup']['p50'] * 1e6, log['lookup']['p99'] * 1e6,
+                                log['save']['p50'] * 1e6, log['save']['p99'] * 1e6, log['flush_per_entry'] * 1e6,
+                                log['file_bytes']))
+        if log['fuzzy_lookup']:
+            print('log {:<8} fuzzy lookup p50 {:.1f}us p99 {:.1f}us'.format(
+                log['entries'], log['fuzzy_lookup']['p50'] * 1e6, log['fuzzy_lookup']['p99'] * 1e6))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
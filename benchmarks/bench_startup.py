@@ -0,0 +1,79 @@
+"""
+Import time and startup time of cp2trans.
+
+Each case runs in a fresh interpreter. "cp2trans/config.ini" must exist, as for any other run.
+
+    python benchmarks/bench_startup.py [-n repeat] [-o result.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = {
+    'interpreter': ['-c', 'pass'],
+    'import': ['-c', 'import cp2trans.cp2trans'],
+    'help': ['-m', 'cp2trans.cp2trans', '-h'],
+    'passwd': ['-m', 'cp2trans.cp2trans', '--passwd', os.devnull+'.missing'],  # Exits right after startup.
+}
+
+
+def run(args, repeat):
+    env = dict(os.environ, PYTHONPATH=BASE_DIR)
+    periods = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable]+args, env=env, cwd=BASE_DIR, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        periods.append(time.perf_counter() - start)
+    periods.sort()
+    return {'min': periods[0], 'median': periods[len(periods) // 2], 'max': periods[-1]}
+
+
+def slowest_imports(top):
+    # Parse "import time: self [us] | cumulative | imported package" from -X importtime. Nested imports are indented
+    # and listed before the module importing them.
+    env = dict(os.environ, PYTHONPATH=BASE_DIR)
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import cp2trans.cp2trans'], env=env,
+                            cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True).stderr
+    children = []
+    for line in stderr.splitlines():
+        items = line.split('|')
+        if len(items) != 3 or not items[1].strip().isdigit():
+            continue
+        name = items[2].rstrip()[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0 and name == 'cp2trans.cp2trans':
+            break
+        elif depth == 0:
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), int(items[1]) / 1e6))
+    return dict(sorted(children, key=lambda item: -item[1])[:top])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cp2trans import and startup time.')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('-t', '--top', type=int, default=10, help='Number of slowest imports to report.')
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+    results = {'python': sys.version.split()[0],
+               'startup': {name: run(case, args.repeat) for name, case in CASES.items()},
+               'slowest_imports': slowest_imports(args.top)}
+    for name, period in results['startup'].items():
+        print('{:<12} median {:.3f}s  min {:.3f}s  max {:.3f}s'.format(name, period['median'], period['min'],
+                                                                     period['max']))
+    for name, period in results['slowest_imports'].items():
+        print('{:<12} {:.3f}s'.format(name, period))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
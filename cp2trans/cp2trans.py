@@ -4,28 +4,38 @@ import re
 import sys
 import time
 import json
+import zlib
 import uuid
-import urllib
+import urllib.parse
+import ctypes
+import queue
 import random
+import signal
+import sqlite3
 import getpass
 import logging
+import shutil
+import hmac
 import hashlib
+import mmap
+import bisect
+import struct
 import argparse
+import array
+import functools
+import itertools
+import contextlib
+import threading
 import subprocess
 import configparser
+import unicodedata
 from datetime import datetime
-from multiprocessing import Process
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
-import MeCab
 import i18n
-import pydub
-import romkan
-import requests
 import pyperclip
-from Crypto.Cipher import AES
-from pydub.playback import play
-from google.cloud import translate_v3beta1 as translate
+# Cloud SDKs, MeCab, pydub, requests and Crypto are imported on first use, see "region lazy clients".
 
 
 # region consts
@@ -38,12 +48,50 @@ SOURCE_ALL = ('ja', )
 TARGET_YOUDAO = ('zh-CHS', )
 # AWS translate supported languages.
 TARGET_AWS = ('en', )
+# Default translate engines, in the order of their results being printed.
+ENGINES = ('youdao', 'aws', 'google')
+LATENCY_SAMPLES = 1000  # Latest request latencies kept by each engine.
+HEDGE_MIN_SAMPLES = 20  # A backup request is only sent once the p95 latency of the engine is known from this many.
 DIVIDING_TITLE = '- '*10+'{} '+'- '*10
 DIVIDING_LINE = '= '*25
 TEST_STRING = '8月3日に放送された「中居正広の金曜日のスマイルたちへ」(TBS系)で、1日たった5分で' \
               'ぽっこりおなかを解消するというダイエット方法を紹介。キンタロー。のダイエットにも密着。'
 CONFIG_INI = 'config.ini'
+USAGE_JSON = 'usage.json'  # Monthly usage before it was kept in USAGE_DB, imported once.
+USAGE_DB = 'usage.db'
+LOG_STORE_EXT = '.db'  # Logs are stored in SQLite, ".json" and whole-file encrypted logs will be migrated.
+LOG_KDF_ITERATIONS = 200000  # PBKDF2 iterations deriving the keys of an encrypted log.
+LOG_CHECK_VALUE = b'cp2trans'  # Sealed into an encrypted log to verify its password.
+# Translation packs: the header, then the records, then the sorted hashes of the pastes, the offsets of their records
+# and the lengths of each paste and entry, all little-endian.
+PACK_MAGIC = b'CP2TPACK'
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct('<8sIIQ')  # magic, version, count, offset of the index
+# Fuzzy lookup: one permutation MinHash signatures of character bigrams, split into bands of rows. Two pastes become
+# candidates if any band is equal, then the most similar candidate is served if it scores at least the threshold.
+FUZZY_BANDS = 4
+FUZZY_ROWS = 4
+FUZZY_POSTINGS = 64  # At most this many pastes are read for each band,
+FUZZY_CANDIDATES = 8  # and the ones sharing the most bands are scored.
+FUZZY_VERSION = 2  # Version of normalize(), an index built by an older one is built again.
+FURIGANA = re.compile(r'[(《〈][ぁ-ゖァ-ヺー]+[)》〉]')  # Readings in brackets after kanji, after NFKC.
+# A sentence ends after these outside brackets, after a quote followed by another one, or at a line break.
+SENTENCE_ENDS = '。．！？!?'
+OPENING_BRACKETS = '「『（(〔【'
+CLOSING_BRACKETS = '」』）)〕】'
+SPACELESS_LANGUAGES = ('zh', 'ja')  # Translated sentences are joined without spaces.
+TRAILING_PUNCTUATION = '。、,.!?…‥・~～♪'
+QUOTES = '「」『』"\''
 API_TOLERATED_DELAY = 1.0  # If API request period is greater than it, log an info.
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded.
+HISTOGRAM_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RETRY_STATUS = (429, 500, 502, 503, 504)  # HTTP status codes worth a retry.
+WATCHERS = ('auto', 'poll', 'sequence', 'notify')
+POLL_MIN_INTERVAL = 0.1  # Polling interval right after a clipboard change.
+POLL_BACKOFF = 1.5  # Polling interval grows by this factor while idle, up to --interval.
+SEQUENCE_INTERVAL = 0.05  # Checking the clipboard sequence number costs nearly nothing.
+WATCH_RETRY_DELAY = 1.0  # Wait before reading the clipboard again after it failed, e.g. "OpenClipboard failed".
+DAEMON_PORT = 8765  # Default port of "cp2trans serve".
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 config = configparser.ConfigParser()
 if not os.path.isfile(os.path.join(BASE_DIR, 'config.ini')):
@@ -72,6 +120,7 @@ FILE_NOT_FOUND = i18n.t('FILE_NOT_FOUND')
 FOLDER_NOT_FOUND = i18n.t('FOLDER_NOT_FOUND')
 SECTION_NOT_FOUND = i18n.t('SECTION_NOT_FOUND')
 SAVING_TO_PLEASE_WAIT = i18n.t('SAVING_TO_PLEASE_WAIT')
+MIGRATING_LOG = i18n.t('MIGRATING_LOG')
 SECTION_IS_PRESERVED = i18n.t('SECTION_IS_PRESERVED')
 CHOOSE_A_TARGET = i18n.t('CHOOSE_A_TARGET')
 INPUT_OLD_PASSWORD = i18n.t('INPUT_OLD_PASSWORD')
@@ -79,6 +128,7 @@ INPUT_NEW_PASSWORD = i18n.t('INPUT_NEW_PASSWORD')
 INPUT_PASSWORD_TO_ENCRYPT = i18n.t('INPUT_PASSWORD_TO_ENCRYPT')
 INPUT_PASSWORD_TO_DECRYPT = i18n.t('INPUT_PASSWORD_TO_DECRYPT')
 START_MONITORING = i18n.t('START_MONITORING')
+WATCHER_FALLBACK = i18n.t('WATCHER_FALLBACK')
 OVER_CHARACTERS = i18n.t('OVER_CHARACTERS')
 DONE = i18n.t('DONE')
 START_AGTH_FROM = i18n.t('START_AGTH_FROM')
@@ -86,6 +136,12 @@ INVALID_TARGET = i18n.t('INVALID_TARGET')
 LOG_WONT_BE_SAVED = i18n.t('LOG_WONT_BE_SAVED')
 TTS_PLAYING_WITH_VOICE = i18n.t('TTS_PLAYING_WITH_VOICE')
 REQUEST_FINISHED_IN = i18n.t('REQUEST_FINISHED_IN')
+BUDGET_EXCEEDED = i18n.t('BUDGET_EXCEEDED')
+BUDGET_USAGE = i18n.t('BUDGET_USAGE')
+BATCH_SKIPPED = i18n.t('BATCH_SKIPPED')
+BATCH_PROGRESS = i18n.t('BATCH_PROGRESS')
+BATCH_FINISHED = i18n.t('BATCH_FINISHED')
+ENGINE_TIMEOUT = i18n.t('ENGINE_TIMEOUT')
 HELP_PASSED = i18n.t('HELP_PASSED')
 HELP_PROFILE = i18n.t('HELP_PROFILE')
 HELP_LOG = i18n.t('HELP_LOG')
@@ -96,13 +152,41 @@ HELP_NUMBER = i18n.t('HELP_NUMBER')
 HELP_SOURCE = i18n.t('HELP_SOURCE')
 HELP_TARGET = i18n.t('HELP_TARGET')
 HELP_DISABLE = i18n.t('HELP_DISABLE')
+HELP_ENGINES = i18n.t('HELP_ENGINES')
+HELP_CONCURRENT = i18n.t('HELP_CONCURRENT')
+HELP_TIMEOUT = i18n.t('HELP_TIMEOUT')
+HELP_RACE = i18n.t('HELP_RACE')
+HELP_HEDGE = i18n.t('HELP_HEDGE')
+HELP_FUZZY = i18n.t('HELP_FUZZY')
+HELP_SEGMENT = i18n.t('HELP_SEGMENT')
+HELP_STREAM = i18n.t('HELP_STREAM')
+HELP_PREFETCH = i18n.t('HELP_PREFETCH')
+HELP_OUTPUT = i18n.t('HELP_OUTPUT')
+BUILDING_FUZZY_INDEX = i18n.t('BUILDING_FUZZY_INDEX')
 HELP_INTERVAL = i18n.t('HELP_INTERVAL')
+HELP_WATCHER = i18n.t('HELP_WATCHER')
 HELP_AGTH = i18n.t('HELP_AGTH')
 HELP_OPT = i18n.t('HELP_OPT')
+BATCH_DESCRIPTION = i18n.t('BATCH_DESCRIPTION')
+HELP_BATCH_INPUT = i18n.t('HELP_BATCH_INPUT')
+HELP_BATCH_SIZE = i18n.t('HELP_BATCH_SIZE')
+HELP_CONNECT = i18n.t('HELP_CONNECT')
+SERVE_DESCRIPTION = i18n.t('SERVE_DESCRIPTION')
+HELP_HOST = i18n.t('HELP_HOST')
+HELP_PORT = i18n.t('HELP_PORT')
+HELP_SOCKET = i18n.t('HELP_SOCKET')
+DAEMON_LISTENING = i18n.t('DAEMON_LISTENING')
+DAEMON_UNREACHABLE = i18n.t('DAEMON_UNREACHABLE')
+HELP_PACK = i18n.t('HELP_PACK')
+PACK_DESCRIPTION = i18n.t('PACK_DESCRIPTION')
+HELP_PACK_OUTPUT = i18n.t('HELP_PACK_OUTPUT')
+HELP_PACK_INPUTS = i18n.t('HELP_PACK_INPUTS')
+HELP_PACK_ENCRYPT = i18n.t('HELP_PACK_ENCRYPT')
+PACK_BUILT = i18n.t('PACK_BUILT')
+INVALID_PACK = i18n.t('INVALID_PACK')
 # endregion
 
 # region global vars
-aws_client = boto3.client('translate')
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=config.getint('global', 'log_level', fallback=logging.INFO))
 if not os.path.exists(os.path.join(BASE_DIR, CONFIG_INI)):
@@ -119,13 +203,26 @@ except configparser.NoSectionError as e:
 if config.has_section(DEFAULT_SECTION):
     logger.error(SECTION_IS_PRESERVED.format(DEFAULT_SECTION))
     exit(1)
-if not os.path.exists(neologd_path):
-    logger.error(FOLDER_NOT_FOUND.format(neologd_path))
-    exit(1)
-mecab_wakati = MeCab.Tagger('-Owakati -d '+neologd_path)
-mecab_chasen = MeCab.Tagger('-Ochasen -d '+neologd_path)
-client = translate.TranslationServiceClient()
-parent = client.location_path('cp2trans-jp', 'global')
+# Connection settings shared by all translate engines.
+pool_size = config.getint('global', 'pool_size', fallback=10)
+connect_timeout = config.getfloat('global', 'connect_timeout', fallback=3.05)
+read_timeout = config.getfloat('global', 'read_timeout', fallback=10.0)
+retries = config.getint('global', 'retries', fallback=3)
+backoff = config.getfloat('global', 'backoff', fallback=0.5)
+# Bounds of each in-process LRU cache.
+cache_size = config.getint('global', 'cache_size', fallback=4096)
+cache_memory = config.getint('global', 'cache_memory', fallback=16 * 1024 * 1024)
+# TTS audio cached on disk.
+tts_cache = config.get('global', 'tts_cache', fallback=os.path.join(BASE_DIR, 'tts_cache'))
+tts_cache_size = config.getint('global', 'tts_cache_size', fallback=256 * 1024 * 1024)
+# Stage latency metrics dumped to a file, as JSON if it ends with ".json" or else in Prometheus text format.
+metrics_file = config.get('global', 'metrics_file', fallback=None)
+metrics_interval = config.getfloat('global', 'metrics_interval', fallback=10.0)
+# Encoding of the text hook stream read with "--stream".
+stream_encoding = config.get('global', 'stream_encoding', fallback='utf-8')
+# Log entries are written in the background every log_flush_interval seconds, or once log_flush_entries are pending.
+log_flush_interval = config.getfloat('global', 'log_flush_interval', fallback=2.0)
+log_flush_entries = config.getint('global', 'log_flush_entries', fallback=64)
 # endregion
 
 # region argparse
@@ -139,6 +236,8 @@ parser.add_argument('-p', '--profile', dest='profile', metavar='section', help=H
 # region logger
 parser.add_argument('-l', '--log', dest='log', metavar='log_file', help=HELP_LOG)
 parser.add_argument('-e', '--encrypt', dest='encrypt', metavar='password', help=HELP_ENCRYPT)
+parser.add_argument('-f', '--fuzzy', dest='fuzzy', metavar='threshold', type=float, default=0.0, help=HELP_FUZZY)
+parser.add_argument('--pack', dest='pack', metavar='pack1,pack2', default='', help=HELP_PACK)
 # endregion
 # region tts
 parser.add_argument('-v', '--voice', dest='voice', choices=('0', '1',), default=None, help=HELP_TTS)
@@ -146,15 +245,434 @@ parser.add_argument('-m', '--match', dest='match', metavar='pattern', default=No
 # endregion
 # region translation
 parser.add_argument('-n', '--number', dest='number', metavar='number', type=int, default=256, help=HELP_NUMBER)
+parser.add_argument('--segment', dest='segment', action='store_true', default=False, help=HELP_SEGMENT)
 parser.add_argument('-s', '--source', dest='source', metavar='lang_code', default='ja', help=HELP_SOURCE)
-parser.add_argument('-t', '--target', dest='target', metavar='lang_code1,lang_code2,lang_code3', default='zh-CHS,en', help=HELP_TARGET)
-parser.add_argument('-d', '--disable', dest='disable', action='store_true', default=False, help=HELP_DISABLE)
+parser.add_argument('-t', '--target', dest='target', metavar='lang_code1,lang_code2,lang_code3', default='zh-CHS,en,zh-CN', help=HELP_TARGET)
+parser.add_argument('--engines', dest='engines', metavar='engine1,engine2,engine3', default=','.join(ENGINES), help=HELP_ENGINES)
+parser.add_argument('-d', '--disable', dest='disable', metavar='engine1,engine2', default='', help=HELP_DISABLE)
+parser.add_argument('-c', '--concurrent', dest='concurrent', action='store_true', default=False, help=HELP_CONCURRENT)
+parser.add_argument('--timeout', dest='timeout', metavar='seconds', type=float, default=10.0, help=HELP_TIMEOUT)
+parser.add_argument('--race', dest='race', action='store_true', default=False, help=HELP_RACE)
+parser.add_argument('--hedge', dest='hedge', action='store_true', default=False, help=HELP_HEDGE)
 # endregion
 # region text hook
 parser.add_argument('-i', '--interval', dest='interval', metavar='seconds', type=float, default=1.0, help=HELP_INTERVAL)
+parser.add_argument('-w', '--watcher', dest='watcher', choices=WATCHERS, default='auto', help=HELP_WATCHER)
 parser.add_argument('-a', '--agth', dest='agth', metavar='agth_path', help=HELP_AGTH)
 parser.add_argument('-o', '--opt', dest='opt', metavar='agth_opts', default='', help=HELP_OPT)
+parser.add_argument('--stream', dest='stream', metavar='source', help=HELP_STREAM)
+parser.add_argument('--prefetch', dest='prefetch', metavar='lines', type=int, default=5, help=HELP_PREFETCH)
+# endregion
+# region output
+parser.add_argument('--output', dest='output', metavar='output1,output2', default='terminal', help=HELP_OUTPUT)
+# endregion
+# region daemon
+parser.add_argument('--connect', dest='connect', metavar='url', help=HELP_CONNECT)
+# endregion
+# region batch
+# "cp2trans batch [input]" takes the same options as the clipboard mode.
+batch_parser = argparse.ArgumentParser(prog='cp2trans batch', description=BATCH_DESCRIPTION, parents=[parser],
+                                       conflict_handler='resolve')
+batch_parser.add_argument('input', metavar='input', nargs='?', default='-', help=HELP_BATCH_INPUT)
+batch_parser.add_argument('-b', '--batch-size', dest='batch_size', metavar='number', type=int, default=32,
+                          help=HELP_BATCH_SIZE)
+# endregion
+# region serve
+# "cp2trans serve" takes the same options as the clipboard mode, as the defaults of the requests it serves.
+serve_parser = argparse.ArgumentParser(prog='cp2trans serve', description=SERVE_DESCRIPTION, parents=[parser],
+                                       conflict_handler='resolve')
+serve_parser.add_argument('--host', dest='host', metavar='host', default='127.0.0.1', help=HELP_HOST)
+serve_parser.add_argument('--port', dest='port', metavar='port', type=int, default=DAEMON_PORT, help=HELP_PORT)
+serve_parser.add_argument('--socket', dest='socket', metavar='path', help=HELP_SOCKET)
+# endregion
+# region pack
+pack_parser = argparse.ArgumentParser(prog='cp2trans pack', description=PACK_DESCRIPTION)
+pack_parser.add_argument('output', metavar='output', help=HELP_PACK_OUTPUT)
+pack_parser.add_argument('inputs', metavar='input', nargs='+', help=HELP_PACK_INPUTS)
+pack_parser.add_argument('-e', '--encrypt', dest='encrypt', metavar='password', help=HELP_PACK_ENCRYPT)
+# endregion
+# endregion
+
+
+# region lazy clients
+def lazy(factory):
+    # Create the object on first call only, so that startup never pays for an engine it does not use.
+    lock, instance = threading.Lock(), []
+
+    @functools.wraps(factory)
+    def wrapper():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    return wrapper
+
+
+@lazy
+def session():
+    # Keep-alive connections to openapi.youdao.com are reused by every request.
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    # urllib3 renamed "method_whitelist" to "allowed_methods", False means retry on any method. Translate and TTS
+    # requests are POSTs billed once sent, so only the ones which never reached the server (connect errors) or which
+    # it refused (RETRY_STATUS) are sent again, never one which timed out while being read.
+    methods = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+    retry = Retry(total=retries, read=0, backoff_factor=backoff, status_forcelist=RETRY_STATUS, raise_on_status=False,
+                  **{methods: False})
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
+    return s
+
+
+@lazy
+def aws_client():
+    import boto3
+    from botocore.config import Config
+    return boto3.client('translate', config=Config(connect_timeout=connect_timeout,
+                                                   read_timeout=read_timeout,
+                                                   max_pool_connections=pool_size,
+                                                   retries={'max_attempts': retries}))
+
+
+@lazy
+def google_client():
+    # Return the client, its location path and its retry policy.
+    from google.api_core.retry import Retry
+    from google.cloud import translate_v3beta1 as translate
+    client = translate.TranslationServiceClient()
+    return (client, client.location_path('cp2trans-jp', 'global'),
+            Retry(initial=backoff, maximum=backoff * 2 ** retries, deadline=read_timeout))
+
+
+@lazy
+def mecab_chasen():
+    import MeCab
+    if not os.path.exists(neologd_path):
+        logger.error(FOLDER_NOT_FOUND.format(neologd_path))
+        exit(1)
+    return MeCab.Tagger('-Ochasen -d '+neologd_path)
+
+
+@lazy
+def simpleaudio():
+    # Optional, lets TTS stop an utterance without ffplay.
+    try:
+        import simpleaudio
+    except ImportError:
+        return None
+    return simpleaudio
+
+
+def warm_up(profile):
+    # Create what the profile is going to use in the background, before the first paste needs it.
+    factories = [session] if 'youdao' not in profile.disable or profile.voice else []
+    if 'aws' not in profile.disable:
+        factories.append(aws_client)
+    if 'google' not in profile.disable:
+        factories.append(google_client)
+    if profile.source == 'ja':
+        factories.append(mecab_chasen)
+
+    def run():
+        for factory in factories:
+            try:
+                factory()
+            except Exception as e:
+                logger.debug('Failed to warm up {}: {}'.format(factory.__name__, e))
+    threading.Thread(target=run, daemon=True).start()
+# endregion
+
+
+# region rate limit
+class TokenBucket:
+    """
+    Token bucket refilled with `rate` tokens per second. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._capacity = max(rate, 1)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    def delay(self, amount):
+        # Seconds to wait until `amount` tokens are available.
+        if self._rate <= 0:
+            return 0
+        amount = min(amount, self._capacity)  # A large paste only has to wait for a full bucket,
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        return max(amount - self._tokens, 0) / self._rate
+
+    def consume(self, amount):
+        # and is charged in full, the debt delaying the next requests until it is repaid.
+        if self._rate > 0:
+            self._tokens -= amount
+
+
+class EngineBudget:
+    """
+    Requests and characters per second of an engine, plus its characters per month.
+    """
+
+    def __init__(self, rps=0, cps=0, monthly=0):
+        self.requests = TokenBucket(rps)
+        self.chars = TokenBucket(cps)
+        self.monthly = int(monthly)
+        self.session_requests = 0
+        self.session_chars = 0
+        self.dropped = 0
+
+
+class Scheduler:
+    """
+    Per engine budgets. `acquire()` queues a request until its engine has budget for it, and drops it if its paste is
+    superseded meanwhile or the monthly budget runs out. Monthly usage is kept in "usage.db" besides "config.ini", and
+    checked and added to in one transaction, so that it survives a crash and is shared by processes running at once.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._budgets = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        # The caller holds the database lock.
+        if self._connection is None:
+            legacy = os.path.join(os.path.dirname(self._filepath), USAGE_JSON)
+            migrate = not os.path.isfile(self._filepath) and os.path.isfile(legacy)
+            connection = sqlite3.connect(self._filepath, check_same_thread=False, isolation_level=None, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS usage (month TEXT NOT NULL, engine TEXT NOT NULL, '
+                               'chars INTEGER NOT NULL, PRIMARY KEY (month, engine))')
+            if migrate:
+                try:
+                    with open(legacy, 'r') as f:
+                        usage = json.loads(f.read())
+                    connection.executemany('INSERT OR IGNORE INTO usage VALUES (?, ?, ?)',
+                                           [(month, engine, chars) for month, engines in usage.items()
+                                            for engine, chars in engines.items()])
+                except (OSError, ValueError, AttributeError) as e:
+                    logger.warning('Ignored a broken "{}": {}'.format(legacy, e))
+            self._connection = connection
+        return self._connection
+
+    def _charge(self, engine, chars, limit):
+        # Add `chars` to the monthly usage of `engine`, unless it would go over `limit`.
+        month = datetime.now().strftime('%Y-%m')
+        with self._db_lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')  # Other processes wait, instead of both reading the same usage.
+            try:
+                row = connection.execute('SELECT chars FROM usage WHERE month = ? AND engine = ?',
+                                         (month, engine)).fetchone()
+                used = row[0] if row else 0
+                if limit and used + chars > limit:
+                    return False
+                connection.execute('INSERT OR REPLACE INTO usage VALUES (?, ?, ?)', (month, engine, used + chars))
+                return True
+            finally:
+                connection.execute('COMMIT')
+
+    def _monthly(self):
+        # engine => characters used this month, by all processes.
+        month = datetime.now().strftime('%Y-%m')
+        try:
+            with self._db_lock:
+                return dict(self._connect().execute('SELECT engine, chars FROM usage WHERE month = ?', (month, )))
+        except sqlite3.Error as e:
+            logger.error('Failed to read "{}": {}'.format(self._filepath, e))
+            return {}
+
+    def configure(self, limits):
+        with self._lock:
+            for engine, (rps, cps, monthly) in limits.items():
+                self._budgets[engine] = EngineBudget(rps, cps, monthly)
+
+    def acquire(self, engine, chars, cancelled=None, block=True):
+        with self._lock:
+            budget = self._budgets.setdefault(engine, EngineBudget())
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                budget.dropped += 1
+                logger.debug('Dropped a superseded {} request.'.format(engine))
+                return False
+            with self._lock:
+                delay = max(budget.requests.delay(1), budget.chars.delay(chars))
+                if not delay:
+                    budget.requests.consume(1)
+                    budget.chars.consume(chars)
+                    break
+            if not block:
+                budget.dropped += 1
+                return False
+            if cancelled is not None:
+                cancelled.wait(delay)
+            else:
+                time.sleep(delay)
+        try:
+            charged = self._charge(engine, chars, budget.monthly)
+        except sqlite3.Error as e:
+            # Requests go on without a usage file, only the monthly budget cannot be checked then.
+            logger.error('Failed to update "{}": {}'.format(self._filepath, e))
+            charged = not budget.monthly
+        if not charged:
+            budget.dropped += 1
+            logger.warning(BUDGET_EXCEEDED.format(budget.monthly, engine))
+            return False
+        with self._lock:
+            budget.session_requests += 1
+            budget.session_chars += chars
+        return True
+
+    def usage(self):
+        monthly = self._monthly()
+        return {engine: {'requests': budget.session_requests,
+                         'chars': budget.session_chars,
+                         'dropped': budget.dropped,
+                         'monthly_chars': monthly.get(engine, 0),
+                         'monthly_limit': budget.monthly}
+                for engine, budget in self._budgets.items()}
+
+
+scheduler = Scheduler(os.path.join(BASE_DIR, USAGE_DB))
 # endregion
+
+
+# region metrics
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets, in seconds.
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th quantile, q in [0, 1].
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return None
+
+
+class Metrics:
+    """
+    Latency histograms of the pipeline stages: clipboard read, MeCab, romkan, each engine, TTS fetch, decode and play,
+    and log write. Time a stage with `with metrics.timer('stage'):` or `metrics.observe('stage', seconds)`.
+    """
+
+    def __init__(self):
+        self._histograms = OrderedDict()
+        self._lock = threading.Lock()
+
+    # region public functions
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def to_json(self, usage=None):
+        # With `usage` of the scheduler, the stages and it are two keys of the object.
+        with self._lock:
+            stages = {stage: {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p95': h.quantile(0.95),
+                              'p99': h.quantile(0.99),
+                              'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts))}
+                      for stage, h in self._histograms.items()}
+        return json.dumps(stages if usage is None else {'stages': stages, 'usage': usage}, indent=2)
+
+    def to_prometheus(self, usage=None):
+        lines = []
+        if usage:
+            lines.append('# HELP cp2trans_budget Requests and characters of each engine, and its monthly limit.')
+            lines.append('# TYPE cp2trans_budget gauge')
+            for engine, values in usage.items():
+                for name, value in values.items():
+                    lines.append('cp2trans_budget{{engine="{}",value="{}"}} {}'.format(engine, name, value))
+        lines += ['# HELP cp2trans_stage_seconds Latency of each pipeline stage.',
+                  '# TYPE cp2trans_stage_seconds histogram']
+        with self._lock:
+            for stage, h in self._histograms.items():
+                cumulative = 0
+                for bound, count in zip([repr(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append('cp2trans_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound,
+                                                                                              cumulative))
+                lines.append('cp2trans_stage_seconds_sum{{stage="{}"}} {}'.format(stage, h.sum))
+                lines.append('cp2trans_stage_seconds_count{{stage="{}"}} {}'.format(stage, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filepath, usage=None):
+        # Replace the file at once, so that a scraper never reads a partial dump.
+        text = self.to_json(usage) if filepath.endswith('.json') else self.to_prometheus(usage)
+        with open(filepath+'.tmp', 'w', encoding='utf8') as f:
+            f.write(text)
+        os.replace(filepath+'.tmp', filepath)
+    # endregion
+
+
+metrics = Metrics()
+
+
+def export_metrics(filepath, interval):
+    # Dump metrics every `interval` seconds, and on SIGUSR1 where available.
+    requested = threading.Event()
+
+    def dump():
+        try:
+            metrics.dump(filepath, scheduler.usage())
+        except OSError as e:
+            logger.error('Failed to dump metrics to "{}": {}'.format(filepath, e))
+
+    def loop():
+        while True:
+            requested.wait(interval if interval > 0 else None)
+            requested.clear()
+            dump()
+
+    if hasattr(signal, 'SIGUSR1'):
+        # The handler runs on the main thread, maybe while it holds the lock of the metrics, so the dump is left to
+        # the exporter thread.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: requested.set())
+    threading.Thread(target=loop, daemon=True).start()
+    return dump
+
+
+def log_request_period(api, period):
+    logger.debug('{} finished API request in {:.3f} seconds'.format(api, period))
+    if period > API_TOLERATED_DELAY:
+        logger.info(REQUEST_FINISHED_IN.format(api, '{:.3f}'.format(period)))
 # endregion
 
 
@@ -170,7 +688,7 @@ def youdao_truncate(q):
     size = len(q)
     return q if size <= 20 else q[0:10] + str(size) + q[size - 10:size]
 
-def youdao_translate(text, target='zh-CHS', source='ja'):
+def youdao_translate(text, target='zh-CHS', source='ja', api=YOUDAO_API_HTTPS):
     curtime = str(int(time.time()))
     salt = str(uuid.uuid1())
     sign_str = appid + youdao_truncate(text) + salt + curtime + secretkey
@@ -185,13 +703,9 @@ def youdao_translate(text, target='zh-CHS', source='ja'):
         'salt': salt,
         'sign': sign
     }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    r = requests.post(YOUDAO_API_HTTPS, data=data, headers=headers)
-    start_time = datetime.now()
-    period = (datetime.now() - start_time).seconds
-    logger.debug('Youdao API finished API request in {} seconds'.format(period))
-    if period > API_TOLERATED_DELAY:
-        logger.info(REQUEST_FINISHED_IN.format('Youdao API', period))
+    start_time = time.monotonic()
+    r = session().post(api, data=data, timeout=(connect_timeout, read_timeout))
+    log_request_period('Youdao API', time.monotonic() - start_time)
     if r.ok and 'application/json' in r.headers['Content-type']:
         j = json.loads(r.text)
         if 'translation' in j.keys() and len(j['translation']) > 0:
@@ -203,261 +717,2496 @@ def youdao_translate(text, target='zh-CHS', source='ja'):
         return None
 
 
-def youdao_tts(text, voice='1', lang_type='ja'):
-    if text == '':
-        return
-    salt = str(uuid.uuid1())
-    sign_str = appid + text + salt + secretkey
-    sign = youdao_encrypt(sign_str)
-    data = {
-        'langType': lang_type,
-        'appKey': appid,
-        'q': text,
-        'salt': salt,
-        'sign': sign
-    }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    start_time = datetime.now()
-    r = requests.post(YOUDAO_API_HTTPS, data=data, headers=headers)
-    period = (datetime.now() - start_time).seconds
-    logger.debug('Youdao TTS finished API request in {} seconds'.format(period))
-    if period > API_TOLERATED_DELAY:
-        logger.info(REQUEST_FINISHED_IN.format('Youdao TTS', period))
-    if r.ok and 'audio/mp3' in r.headers['Content-Type']:
-        data = io.BytesIO(r.content)
-        tts = pydub.AudioSegment.from_file(data, format="mp3")
-        logger.info(TTS_PLAYING_WITH_VOICE.format(voice))
-        play(tts)
-        logger.debug('TTS playing finished normally.')
-    elif 'application/json' in r.headers['Content-Type']:
-        logger.error(YOUDAO_TTS_ERROR.format(json.loads(r.text)['errorCode']))
-    else:
-        logger.error(YOUDAO_TTS_ERROR.format(r.status_code))
+def youdao_tts_fetch(text, voice='1', lang_type='ja'):
+    # Return the mp3 and the decoded audio segment.
+    salt = str(uuid.uuid1())
+    sign_str = appid + text + salt + secretkey
+    sign = youdao_encrypt(sign_str)
+    data = {
+        'langType': lang_type,
+        'appKey': appid,
+        'q': text,
+        'salt': salt,
+        'sign': sign
+    }
+    start_time = time.monotonic()
+    r = session().post(YOUDAO_TTSAPI_HTTPS, data=data, timeout=(connect_timeout, read_timeout))
+    period = time.monotonic() - start_time
+    metrics.observe('tts_fetch', period)
+    log_request_period('Youdao TTS', period)
+    if r.ok and 'audio/mp3' in r.headers['Content-Type']:
+        import pydub
+        with metrics.timer('tts_decode'):
+            segment = pydub.AudioSegment.from_file(io.BytesIO(r.content), format="mp3")
+        return r.content, segment
+    elif 'application/json' in r.headers['Content-Type']:
+        logger.error(YOUDAO_TTS_ERROR.format(json.loads(r.text)['errorCode']))
+    else:
+        logger.error(YOUDAO_TTS_ERROR.format(r.status_code))
+    return None
+
+
+def aws_translate(text, target='en', source='ja'):
+    start_time = time.monotonic()
+    result_dict = aws_client().translate_text(Text=text,
+                                            SourceLanguageCode=source,
+                                            TargetLanguageCode=target)
+    log_request_period('AWS', time.monotonic() - start_time)
+    r = result_dict.get('TranslatedText', None)
+    if r == None:
+        logger.error(AWS_API_ERROR.format(str(result_dict)))
+        return None
+    else:
+        return r
+
+
+def google_translate(text, target='zh-CN', source='ja'):
+    return google_translate_batch([text], target=target, source=source)[0]
+
+
+def google_translate_batch(texts, target='zh-CN', source='ja'):
+    client, parent, retry = google_client()
+    start_time = time.monotonic()
+    response = client.translate_text(parent=parent, contents=texts, mime_type='text/plain', source_language_code=source,
+                                     target_language_code=target, retry=retry, timeout=read_timeout)
+    log_request_period('Google', time.monotonic() - start_time)
+    try:
+        r = [translation.translated_text for translation in response.translations]
+        assert len(r) == len(texts)
+    except Exception:
+        logger.error(GOOGLE_API_ERROR.format(str(response)))
+        return [None] * len(texts)
+    else:
+        return r
+
+# endregion
+
+
+# region engines
+ENGINE_CLASSES = OrderedDict()  # name => Engine subclass
+
+
+def register_engine(cls):
+    ENGINE_CLASSES[cls.name] = cls
+    return cls
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of sorted `values`, q in [0, 100].
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+class Engine:
+    """
+    A translate engine. Subclasses set `name` and implement `_translate()`, or `_translate_batch()` if they translate
+    many texts in one request. Options are the "config.ini" keys of the profile section over the [global] ones.
+    """
+
+    name = None
+    targets = None  # Supported target languages, None for any.
+    batching = False  # Whether a batch of texts is sent in one request.
+
+    def __init__(self, target, source, options):
+        self.target = target
+        self.source = source
+        self.timeout = float(options.get(self.name+'_timeout', 0)) or None
+        self.calls = 0
+        self.errors = 0
+        self.hedged = 0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    # region public functions
+    def translate(self, text, cancelled=None):
+        return self.translate_batch([text], cancelled)[0]
+
+    def translate_batch(self, texts, cancelled=None):
+        # The request is dropped if `cancelled` is set before the engine has budget for it.
+        if not scheduler.acquire(self.name, sum(len(text) for text in texts), cancelled):
+            return [None] * len(texts)
+        start_time, failed = time.perf_counter(), False
+        try:
+            results = self._translate_batch(texts)
+        except Exception as e:
+            logger.error('{} translate failed: {}'.format(self.name, e))
+            results, failed = [None] * len(texts), True
+        period = time.perf_counter() - start_time
+        metrics.observe('translate_'+self.name, period)
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self._latencies.append(period)
+        return results
+
+    def translate_hedged(self, text, cancelled=None):
+        # Send a backup request if the first one has not answered within the p95 latency, and return the first
+        # translation of either.
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.translate(text, cancelled)
+        results = queue.Queue()
+
+        def attempt():
+            results.put(self.translate(text, cancelled))
+
+        threading.Thread(target=attempt, daemon=True).start()
+        try:
+            return results.get(timeout=delay)
+        except queue.Empty:
+            pass
+        with self._lock:
+            self.hedged += 1
+        threading.Thread(target=attempt, daemon=True).start()
+        result = results.get()
+        return result if result is not None else results.get()
+
+    def hedge_delay(self):
+        # p95 of the latest latencies, once there are enough of them.
+        with self._lock:
+            latencies = sorted(self._latencies)
+        return percentile(latencies, 95) if len(latencies) >= HEDGE_MIN_SAMPLES else None
+
+    def submit(self, executor, texts, cancelled=None):
+        # Translate in `executor`, the future's result is the list of translations.
+        return executor.submit(self.translate_batch, texts, cancelled)
+
+    async def translate_async(self, text, cancelled=None):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await asyncio.wait_for(loop.run_in_executor(None, self.translate, text, cancelled), self.timeout)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        return {'calls': self.calls, 'errors': self.errors, 'hedged': self.hedged, 'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None}
+    # endregion
+
+    # region private functions
+    def _translate_batch(self, texts):
+        return [self._translate(text) for text in texts]
+
+    def _translate(self, text):
+        raise NotImplementedError
+    # endregion
+
+
+@register_engine
+class YoudaoEngine(Engine):
+    name = 'youdao'
+    targets = TARGET_YOUDAO
+
+    def __init__(self, target, source, options):
+        super().__init__(target, source, options)
+        self._api = options.get('youdao_api', YOUDAO_API_HTTPS)
+
+    def _translate(self, text):
+        return youdao_translate(text, target=self.target, source=self.source, api=self._api)
+
+
+@register_engine
+class AwsEngine(Engine):
+    name = 'aws'
+    targets = TARGET_AWS
+
+    def _translate(self, text):
+        return aws_translate(text, target=self.target, source=self.source)
+
+
+@register_engine
+class GoogleEngine(Engine):
+    name = 'google'
+    batching = True
+
+    def _translate_batch(self, texts):
+        return google_translate_batch(texts, target=self.target, source=self.source)
+
+
+@register_engine
+class MockEngine(Engine):
+    """
+    Deterministic local engine for benchmarking without network access. Each text takes an exponentially distributed
+    latency around "mock_latency" seconds and fails with "mock_error_rate", both seeded by the text itself.
+    """
+
+    name = 'mock'
+    batching = True
+
+    def __init__(self, target, source, options):
+        super().__init__(target, source, options)
+        self._latency = float(options.get('mock_latency', 0.1))
+        self._error_rate = float(options.get('mock_error_rate', 0))
+
+    def _translate_batch(self, texts):
+        delay, failed = 0, False
+        for text in texts:
+            rng = random.Random(text)
+            delay = max(delay, rng.expovariate(1 / self._latency) if self._latency > 0 else 0)
+            failed = failed or rng.random() < self._error_rate
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError('mock error')
+        return ['[{}] {}'.format(self.target, text) for text in texts]
+
+
+class YoudaoStandIn:
+    """
+    Local HTTP stand-in for the Youdao translate API, answering after `latency` seconds and failing with `error_rate`,
+    both seeded by the text. Point "youdao_api" at `url` to run the real Youdao engine without network access.
+    """
+
+    def __init__(self, latency=0.1, error_rate=0.0, port=0):
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                form = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                text, rng = form['q'][0], random.Random(form['q'][0])
+                time.sleep(rng.expovariate(1 / latency) if latency > 0 else 0)
+                if rng.random() < error_rate:
+                    body = {'errorCode': '411'}  # Access frequency limited.
+                else:
+                    body = {'errorCode': '0', 'translation': ['[{}] {}'.format(form['to'][0], text)]}
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{}/api'.format(self._server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+# endregion
+
+
+# region cache
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by both the number of entries and their estimated size in bytes.
+    """
+
+    def __init__(self, maxsize, maxbytes):
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._data = OrderedDict()  # key => (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self._maxsize or self._bytes > self._maxbytes):
+                self._bytes -= self._data.popitem(last=False)[1][1]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'bytes': self._bytes}
+
+
+sentence_cache = LRUCache(cache_size, cache_memory)
+roma_cache = LRUCache(cache_size, cache_memory)
+
+
+class AudioCache:
+    """
+    Content-addressed TTS audio on disk, shared by all processes. Each utterance keeps the downloaded mp3 and the
+    decoded wav, so that replaying it needs neither the network nor ffmpeg. The least recently played utterances are
+    evicted beyond `maxbytes`.
+    """
+
+    def __init__(self, directory, maxbytes):
+        self._directory = directory
+        self._maxbytes = maxbytes
+
+    @staticmethod
+    def key(text, voice, lang_type):
+        return hashlib.sha256(json.dumps([text, voice, lang_type]).encode('utf-8')).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self._directory, key+ext)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key, '.wav'))
+
+    def path(self, key):
+        return self._path(key, '.wav')
+
+    def touch(self, key):
+        # Mark as recently played, eviction goes by the mtime.
+        try:
+            os.utime(self._path(key, '.wav'))
+        except OSError:
+            pass
+
+    def load(self, key):
+        path = self._path(key, '.wav')
+        try:
+            self.touch(key)
+            import pydub
+            return pydub.AudioSegment.from_wav(path)
+        except OSError:
+            return None
+
+    def store(self, key, mp3, segment):
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._path(key, '.mp3')
+        with open(path+'.tmp', 'wb') as f:
+            f.write(mp3)
+        os.replace(path+'.tmp', path)
+        # The wav is written last, it marks a complete entry.
+        path = self._path(key, '.wav')
+        segment.export(path+'.tmp', format='wav')
+        os.replace(path+'.tmp', path)
+        self._evict()
+
+    def _evict(self):
+        entries = {}  # key => (last played, bytes)
+        for entry in os.scandir(self._directory):
+            key, ext = os.path.splitext(entry.name)
+            stat = entry.stat()
+            played, size = entries.get(key, (0, 0))
+            entries[key] = (max(played, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self._maxbytes:
+                break
+            for ext in ('.wav', '.mp3'):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= size
+
+
+audio_cache = AudioCache(tts_cache, tts_cache_size)
+# endregion
+
+
+# region morphological analysis
+class TokenizedSentence:
+    """
+    Morphemes of a paste from a single MeCab pass. Both the spaced source text and the romkan are derived from it.
+
+    As many of them are cached, each morpheme is kept as its offsets in the text rather than as a string of its own,
+    and readings are interned, since the same ones recur across sentences.
+    """
+
+    __slots__ = ('text', 'readings', '_bounds', '_surfaces', '_romkan')
+
+    def __init__(self, text, surfaces, readings):
+        self.text = text
+        self.readings = tuple(sys.intern(reading) for reading in readings)
+        self._bounds, self._surfaces = array.array('I'), None  # start and end of each morpheme in the text
+        position = 0
+        for surface in surfaces:
+            start = text.find(surface, position)
+            if start < 0:
+                # Not a substring, keep the surfaces themselves.
+                self._bounds, self._surfaces = None, tuple(surfaces)
+                break
+            position = start + len(surface)
+            self._bounds.extend((start, position))
+        self._romkan = None
+
+    def __sizeof__(self):
+        # Readings are shared by all sentences, and the text by the key of the cache.
+        return (object.__sizeof__(self) + sys.getsizeof(self._bounds) + sys.getsizeof(self.readings) +
+                sys.getsizeof(self._surfaces) + sum(sys.getsizeof(surface) for surface in self._surfaces or ()) +
+                sys.getsizeof(self._romkan))
+
+    @property
+    def surfaces(self):
+        if self._bounds is None:
+            return self._surfaces
+        bounds = self._bounds
+        return [self.text[bounds[i]:bounds[i+1]] for i in range(0, len(bounds), 2)]
+
+    @property
+    def source(self):
+        return ' '.join(self.surfaces)
+
+    @property
+    def romkan(self):
+        if self._romkan is None:
+            with metrics.timer('romkan'):
+                self._romkan = ' '.join([to_roma(reading) for reading in self.readings])
+        return self._romkan
+
+
+def to_roma(reading):
+    # The same readings recur across different sentences.
+    roma = roma_cache.get(reading)
+    if roma is None:
+        import romkan
+        roma = romkan.to_roma(reading)
+        roma_cache.put(reading, roma, sys.getsizeof(reading) + sys.getsizeof(roma))
+    return roma
+
+
+def tokenize(text):
+    sentence = sentence_cache.get(text)
+    if sentence is None:
+        sentence = _tokenize(text)
+        sentence.romkan  # Derived now, so that it counts towards the size of the sentence in the cache.
+        sentence_cache.put(text, sentence, sys.getsizeof(text) + sys.getsizeof(sentence))
+    return sentence
+
+
+mecab_lock = threading.Lock()  # The tagger is shared by the main loop and the prefetcher.
+
+
+def split_sentences(text):
+    sentences, start, depth = [], 0, 0
+    for i, char in enumerate(text):
+        following = text[i+1:i+2]
+        if char in OPENING_BRACKETS:
+            depth += 1
+        elif char in CLOSING_BRACKETS:
+            depth = max(depth - 1, 0)
+        if char == '\n' or depth == 0 and (
+                char in SENTENCE_ENDS and following not in SENTENCE_ENDS + CLOSING_BRACKETS or
+                char in CLOSING_BRACKETS and (following in OPENING_BRACKETS or following.isspace())):
+            sentences.append(text[start:i+1])
+            start = i + 1
+    sentences.append(text[start:])
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def tokenize_sentences(text, sentences):
+    # Tokenize each sentence, so that the ones seen before come from the cache.
+    tokenized = [tokenize(sentence) for sentence in sentences]
+    return TokenizedSentence(text, [surface for sentence in tokenized for surface in sentence.surfaces],
+                             [reading for sentence in tokenized for reading in sentence.readings])
+
+
+def _tokenize(text):
+    surfaces, readings = [], []
+    # Each chasen line is "surface\treading\tbase\tpos...".
+    with metrics.timer('mecab'), mecab_lock:
+        parsed = mecab_chasen().parse(text)
+    for line in parsed.split('\n'):
+        if line != '' and line != 'EOS':
+            items = line.split('\t')
+            surfaces.append(items[0])
+            readings.append(items[1])
+    return TokenizedSentence(text, surfaces, readings)
+# endregion
+
+
+# region crypto
+def align(value):
+    if isinstance(value, str):
+        value = value.encode('ascii')
+    elif isinstance(value, bytes):
+        pass
+    else:
+        logger.critical('align() only accept str and bytes.')
+        exit(1)
+    while len(value) % 16 != 0:
+        value += b' '
+    return value
+
+
+def decrypt(cipher, key):
+    # bytes => str, legacy whole-file format.
+    assert isinstance(cipher, bytes)
+    from Crypto.Cipher import AES
+    aes = AES.new(align(key), AES.MODE_ECB)
+    return aes.decrypt(align(cipher)).decode('utf-8').rstrip()
+
+
+def load_legacy_log(filepath, password):
+    # Read a log encrypted as a whole by an older version, which is only done to migrate it.
+    with open(filepath, 'rb') as f:
+        try:
+            return json.loads(decrypt(f.read(), password))
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+            logger.error(WRONG_PASSWORD.format(filepath))
+            exit(1)
+
+
+def is_log_store(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+
+# a.b.txt => a.b(insert_text).txt
+# Or abc => abc(insert_text) if dot not found
+def rename(filepath, insert_text):
+    path, ext = os.path.splitext(filepath)
+    return path+insert_text+ext
+
+
+# a.b.db => a.b(new_ext)
+def rename_ext(filepath, new_ext):
+    path, ext = os.path.splitext(filepath)
+    return path+new_ext
+
+
+def open_log(filepath, password=None):
+    # Open an existing log of any format as a LogStore, migrating it into a temporary one if it is a legacy file.
+    if is_log_store(filepath):
+        return EncryptedLogStore(filepath, password) if password else LogStore(filepath)
+    temporary = rename_ext(filepath, '(migrated)'+LOG_STORE_EXT)
+    if os.path.isfile(temporary):
+        os.remove(temporary)
+    log = EncryptedLogStore(temporary, password) if password else LogStore(temporary)
+    log.migrate(filepath)
+    return log
+
+
+def passwd(filepath):
+    # Records are copied one chunk at a time into a new log, the original one is kept.
+    if not os.path.isfile(filepath):
+        logger.error(FILE_NOT_FOUND.format(filepath))
+        exit(1)
+    target = input(CHOOSE_A_TARGET)
+    if target == 'C':
+        old_log = open_log(filepath, getpass.getpass(INPUT_OLD_PASSWORD))
+        old_log.check_password()
+        new_filepath = log_store_filename(rename(filepath, '(encrypted)'))
+        new_log = EncryptedLogStore(new_filepath, getpass.getpass(INPUT_NEW_PASSWORD))
+    elif target == 'E':
+        old_log = open_log(filepath)
+        new_filepath = log_store_filename(rename(filepath, '(encrypted)'))
+        new_log = EncryptedLogStore(new_filepath, getpass.getpass(INPUT_PASSWORD_TO_ENCRYPT.format(filepath)))
+    elif target == 'D':
+        old_log = open_log(filepath, getpass.getpass(INPUT_PASSWORD_TO_DECRYPT.format(filepath)))
+        old_log.check_password()
+        new_filepath = log_store_filename(rename(filepath, '(decrypted)'))
+        new_log = LogStore(new_filepath)
+    else:
+        logger.error(INVALID_TARGET.format(target))
+        exit(1)
+    if os.path.isfile(new_filepath):
+        os.remove(new_filepath)
+    logger.info(SAVING_TO_PLEASE_WAIT.format(new_filepath))
+    new_log.copy_from(old_log.items())
+    new_log.close()
+    old_log.close()
+    if not is_log_store(filepath):
+        os.remove(rename_ext(filepath, '(migrated)'+LOG_STORE_EXT))
+    logger.info(DONE)
+# endregion
+
+# region clipboard
+class FakeClipboard:
+    """
+    In-memory clipboard for running and benchmarking main_loop headlessly.
+    """
+
+    def __init__(self, text=''):
+        self._text = text
+        self._sequence = 0
+        self.changed = threading.Event()
+
+    def copy(self, text):
+        self._text = text
+        self._sequence += 1
+        self.changed.set()
+
+    def paste(self):
+        return self._text
+
+    def sequence(self):
+        return self._sequence
+
+
+class ClipboardWatcher:
+    """
+    Wait for the clipboard text to change. `wait()` returns the new text, or None if it timed out.
+    """
+
+    def __init__(self, backend=pyperclip):
+        self._backend = backend
+        self._text = backend.paste()
+
+    def _check(self):
+        with metrics.timer('clipboard_read'):
+            text = self._backend.paste()
+        if text == self._text:
+            return None
+        self._text = text
+        return text
+
+    def wait(self, timeout=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(ClipboardWatcher):
+    """
+    Poll the clipboard, backing off while idle and tightening again after a change.
+    """
+
+    def __init__(self, backend=pyperclip, interval=1.0):
+        super().__init__(backend)
+        self._max_interval = max(interval, POLL_MIN_INTERVAL)
+        self._interval = POLL_MIN_INTERVAL
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self._interval if deadline is None else min(self._interval, deadline - time.monotonic())
+            time.sleep(max(delay, 0))
+            text = self._check()
+            if text is not None:
+                self._interval = POLL_MIN_INTERVAL
+                return text
+            self._interval = min(self._interval * POLL_BACKOFF, self._max_interval)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+
+class SequenceWatcher(ClipboardWatcher):
+    """
+    Only read the clipboard when its change sequence number moves, e.g. GetClipboardSequenceNumber on Windows.
+    """
+
+    def __init__(self, backend=pyperclip, sequence=None):
+        super().__init__(backend)
+        self._sequence = sequence or ctypes.windll.user32.GetClipboardSequenceNumber
+        self._last = self._sequence()
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            current = self._sequence()
+            if current != self._last:
+                self._last = current
+                text = self._check()
+                if text is not None:
+                    return text
+            time.sleep(SEQUENCE_INTERVAL)
+        return None
+
+
+class EventWatcher(ClipboardWatcher):
+    """
+    Sleep until a notifier sets the `changed` event.
+    """
+
+    def __init__(self, backend, changed):
+        super().__init__(backend)
+        self._changed = changed
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._changed.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            self._changed.clear()
+            text = self._check()
+            if text is not None:
+                return text
+        return None
+
+
+class NotifyWatcher(EventWatcher):
+    """
+    Listen to selection owner changes through a helper command, "wl-paste --watch" on Wayland or "clipnotify" on
+    X11. The helper either prints a line or exits on every change. If it fails, e.g. "wl-paste --watch" on compositors
+    without the data-control protocol such as GNOME, the clipboard is polled instead.
+    """
+
+    def __init__(self, command, backend=pyperclip, interval=1.0):
+        super().__init__(backend, threading.Event())
+        self._command = command
+        self._interval = interval
+        self._process = None
+        self._fallback = None  # PollingWatcher once the helper has failed
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                self._process = subprocess.Popen(self._command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logger.warning('Clipboard helper "{}" failed: {}'.format(self._command[0], e))
+                break
+            for _ in self._process.stdout:
+                self._changed.set()
+            if self._process.wait() != 0:
+                logger.warning('Clipboard helper "{}" exited with {}.'.format(self._command[0],
+                                                                               self._process.returncode))
+                break
+            self._changed.set()
+        logger.warning(WATCHER_FALLBACK.format('notify'))
+        fallback = PollingWatcher(self._backend, self._interval)
+        fallback._text = self._text
+        self._fallback = fallback
+        self._changed.set()  # Wake up wait() to hand over to polling.
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._fallback is None:
+            if not self._changed.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                return None
+            self._changed.clear()
+            if self._fallback is not None:
+                break
+            text = self._check()
+            if text is not None:
+                return text
+        self._fallback._text = self._text
+        text = self._fallback.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        self._text = self._fallback._text
+        return text
+
+    def close(self):
+        if self._process:
+            self._process.kill()
+
+
+def create_watcher(profile, backend=None):
+    if backend is not None:
+        # An in-memory clipboard notifies its changes itself.
+        if hasattr(backend, 'changed'):
+            return EventWatcher(backend, backend.changed)
+        return PollingWatcher(backend, profile.interval)
+    kind = profile.watcher
+    if kind in ('auto', 'sequence') and sys.platform == 'win32':
+        return SequenceWatcher()
+    if kind in ('auto', 'notify'):
+        if os.environ.get('WAYLAND_DISPLAY') and shutil.which('wl-paste'):
+            return NotifyWatcher(['wl-paste', '--watch', 'echo'], interval=profile.interval)
+        if os.environ.get('DISPLAY') and shutil.which('clipnotify'):
+            return NotifyWatcher(['clipnotify'], interval=profile.interval)
+    if kind != 'auto' and kind != 'poll':
+        logger.warning(WATCHER_FALLBACK.format(kind))
+    return PollingWatcher(interval=profile.interval)
+# endregion
+
+
+# region tts
+class TTSWorker:
+    """
+    Long-lived TTS worker. A fetch thread downloads and decodes audio into the audio cache, ahead of playback for
+    prefetched lines, while a play thread plays the latest spoken line and stops the one being played.
+    """
+
+    def __init__(self):
+        self._fetches = queue.PriorityQueue()  # (priority, order, request), spoken lines go before prefetched ones.
+        self._plays = queue.Queue()
+        self._order = 0
+        self._latest = None  # Key of the latest spoken line.
+        self._playing = None
+        self._lock = threading.Lock()
+        self.latencies = []  # Seconds from speak() to the start of playback.
+        self.hits = 0
+        self.misses = 0
+        threading.Thread(target=self._fetch_loop, daemon=True).start()
+        threading.Thread(target=self._play_loop, daemon=True).start()
+
+    # region public functions
+    def speak(self, text, voice='1', lang_type='ja'):
+        key = audio_cache.key(text, voice, lang_type)
+        with self._lock:
+            self._latest = key
+        self._stop()
+        self._put(0, (key, text, voice, lang_type, time.monotonic()))
+
+    def prefetch(self, text, voice='1', lang_type='ja'):
+        self._put(1, (audio_cache.key(text, voice, lang_type), text, voice, lang_type, None))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {'played': len(latencies), 'hits': self.hits, 'misses': self.misses,
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'max': latencies[-1] if latencies else None}
+    # endregion
+
+    # region private functions
+    def _put(self, priority, request):
+        with self._lock:
+            self._order += 1
+            self._fetches.put((priority, self._order, request))
+
+    def _fetch_loop(self):
+        while True:
+            _, _, (key, text, voice, lang_type, requested) = self._fetches.get()
+            spoken = requested is not None
+            if spoken and key != self._latest:
+                continue  # Superseded before it was fetched.
+            if key in audio_cache:
+                self.hits += 1
+                audio_cache.touch(key)
+            else:
+                self.misses += 1
+                # Never wait for TTS budget, the next paste would make it useless anyway.
+                if not scheduler.acquire('tts', len(text), block=False):
+                    continue
+                try:
+                    fetched = youdao_tts_fetch(text, voice, lang_type)
+                except Exception as e:
+                    logger.error(YOUDAO_TTS_ERROR.format(e))
+                    continue
+                if fetched is None:
+                    continue
+                try:
+                    audio_cache.store(key, *fetched)
+                except OSError as e:  # e.g. the disk is full, the fetch thread must go on.
+                    logger.error(YOUDAO_TTS_ERROR.format(e))
+                    continue
+            if spoken:
+                self._plays.put((key, voice, requested))
+
+    def _play_loop(self):
+        while True:
+            key, voice, requested = self._plays.get()
+            if key != self._latest:
+                continue
+            self.latencies.append(time.monotonic() - requested)
+            metrics.observe('tts_play', time.monotonic() - requested)
+            logger.info(TTS_PLAYING_WITH_VOICE.format(voice))
+            try:
+                self._play(key)
+            except Exception as e:
+                logger.error(YOUDAO_TTS_ERROR.format(e))
+            logger.debug('TTS playing finished.')
+
+    def _play(self, key):
+        if simpleaudio() is not None:
+            playing = simpleaudio().WaveObject.from_wave_file(audio_cache.path(key)).play()
+        elif shutil.which('ffplay'):
+            playing = subprocess.Popen(['ffplay', '-nodisp', '-autoexit', '-loglevel', 'quiet', audio_cache.path(key)])
+        else:
+            from pydub.playback import play
+            play(audio_cache.load(key))  # Cannot be stopped.
+            return
+        with self._lock:
+            self._playing = playing
+        if key != self._latest:
+            self._stop()  # A newer line came in while starting.
+        if simpleaudio() is not None:
+            playing.wait_done()
+        else:
+            playing.wait()
+
+    def _stop(self):
+        with self._lock:
+            playing, self._playing = self._playing, None
+        if playing is None:
+            return
+        if simpleaudio() is not None:
+            playing.stop()
+        else:
+            playing.kill()
+        logger.debug('Previous TTS utterance stopped.')
+    # endregion
+# endregion
+
+
+# region stream
+class LineStream:
+    """
+    Ordered lines of a text hook stream, read by a thread from a file, a pipe or stdin. With `follow`, the end of a
+    file is waited on for more lines, like "tail -f".
+    """
+
+    def __init__(self, f, follow=False, interval=1.0, on_line=None):
+        self.lines = []
+        self._index = {}  # line => its latest index
+        self._lock = threading.Lock()
+        self._on_line = on_line
+        threading.Thread(target=self._read, args=(f, follow, interval), daemon=True).start()
+
+    # region public functions
+    def position(self, line):
+        with self._lock:
+            return self._index.get(line)
+
+    def window(self, position, count):
+        # The `count` lines after `position`.
+        with self._lock:
+            return self.lines[position+1:position+1+count]
+    # endregion
+
+    # region private functions
+    def _read(self, f, follow, interval):
+        while True:
+            line = f.readline()
+            if line == '':
+                if not follow:
+                    return
+                time.sleep(interval)
+                continue
+            line = line.strip()
+            with self._lock:
+                if not line or self.lines and self.lines[-1] == line:
+                    continue
+                self._index[line] = len(self.lines)
+                self.lines.append(line)
+            if self._on_line:
+                self._on_line(line)
+    # endregion
+
+
+class Prefetcher:
+    """
+    Translate, and fetch TTS audio of, the lines of a stream following the latest paste, so that they are in the log
+    before the player advances. Lines are done one by one and only while the main loop has no pending job.
+    """
+
+    def __init__(self, profile, f, follow, count, tts_worker=None):
+        self._profile = profile
+        self._count = count
+        self._tts_worker = tts_worker
+        self._position = None
+        self._done = set()
+        self._changed = threading.Condition()
+        self._idle = threading.Event()
+        self._idle.set()
+        self.prefetched = 0
+        self._stream = LineStream(f, follow, profile.interval, self.notify)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    # region public functions
+    def advance(self, paste):
+        position = self._stream.position(paste)
+        if position is not None:
+            with self._changed:
+                self._position = position
+                self._changed.notify()
+
+    def notify(self, line=None):
+        with self._changed:
+            self._changed.notify()
+
+    def pause(self):
+        self._idle.clear()
+
+    def resume(self):
+        self._idle.set()
+    # endregion
+
+    # region private functions
+    def _loop(self):
+        while True:
+            with self._changed:
+                line = self._next()
+                while line is None:
+                    self._changed.wait()
+                    line = self._next()
+            self._idle.wait()
+            try:
+                with metrics.timer('prefetch'):
+                    self._prefetch(line)
+            except Exception as e:
+                logger.error('Failed to prefetch "{}": {}'.format(line, e))
+            self._done.add(line)
+
+    def _next(self):
+        # The first line in the window which is not done yet.
+        if self._position is None:
+            return None
+        for line in self._stream.window(self._position, self._count):
+            if line not in self._done and len(line) <= self._profile.number:
+                return line
+        return None
+
+    def _prefetch(self, line):
+        profile = self._profile
+        entry = dict(profile.log.get(line) or {})
+        missing = [engine for name, engine in profile.engines.items()
+                   if entry.get(name) is None and name not in profile.disable]
+        if missing or 'source' not in entry:
+            for engine in missing:
+                entry[engine.name] = engine.translate(line)
+            if profile.source == 'ja':
+                sentence = tokenize(line)
+                entry['source'], entry['romkan'] = sentence.source, sentence.romkan
+            else:
+                entry['source'], entry['romkan'] = line, None
+            for name in profile.engines:
+                entry.setdefault(name, None)
+            profile.log[line] = entry
+            self.prefetched += 1
+            logger.debug('Prefetched "{}".'.format(line))
+        if self._tts_worker and (profile.match is None or re.search(profile.match, line)):
+            self._tts_worker.prefetch(line, profile.voice, profile.source)
+    # endregion
+
+
+def open_stream(profile):
+    # "-" for stdin, "agth" for the stdout of AGTH started with "--agth", or else a file or a named pipe.
+    if profile.stream == '-':
+        return sys.stdin, False
+    if profile.stream == 'agth':
+        return io.TextIOWrapper(profile.agth_process.stdout, encoding=stream_encoding, errors='replace'), False
+    return open(profile.stream, 'r', encoding=stream_encoding, errors='replace'), True
+# endregion
+
+
+# region render
+def format_event(event):
+    # Text of an event as printed in the terminal, or None if it is not printed.
+    if event['type'] == 'done':
+        return DIVIDING_LINE + '\n'
+    if event['type'] not in ('source', 'romkan', 'result'):
+        return None
+    notes = [event['from']] if event.get('from') else []
+    if event.get('first'):
+        notes.append('first')
+    title = event.get('engine', event['type']).upper()
+    return '{}\n{}\n'.format(DIVIDING_TITLE.format('{} ({})'.format(title, ', '.join(notes)) if notes else title),
+                             event['text'])
+
+
+class TerminalOutput:
+    """
+    Events printed as titled blocks closed by a dividing line.
+    """
+
+    def __init__(self, f=None):
+        self._f = f
+
+    def write(self, events):
+        f = self._f or sys.stdout  # Looked up each time, as sys.stdout may be replaced.
+        text = ''.join(filter(None, map(format_event, events)))
+        if text:
+            f.write(text)
+            f.flush()
+
+    def close(self):
+        pass
+
+
+class JsonLinesOutput:
+    """
+    Events written as one JSON object per line, for other programs to read the results as they arrive.
+    """
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, events):
+        self._f.write(''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in events))
+        self._f.flush()
+
+    def close(self):
+        if self._f is not sys.stdout:
+            self._f.close()
+
+
+class OverlayOutput:
+    """
+    The latest paste and its translations as plain text in a file, which overlay tools such as a text source of OBS
+    show and reload when it changes. The file is replaced as a whole, so that it is never read half written.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lines = {}  # "paste" or engine => its line
+
+    def write(self, events):
+        changed = False
+        for event in events:
+            if event['type'] == 'source':
+                self._lines = {'paste': event['paste']}
+                changed = True
+            elif event['type'] == 'result' and event['text'] is not None:
+                self._lines[event['engine']] = event['text']
+                changed = True
+        if changed:
+            temp = self._filename + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(self._lines.values()) + '\n')
+            os.replace(temp, self._filename)
+
+    def close(self):
+        pass
+
+
+class Renderer:
+    """
+    Output stage of the pipeline. The main loop and the daemon client emit the structured events of each paste, the
+    same the daemon streams: "source", "romkan", "result" of each engine with "from" telling a log or cache hit, then
+    "done", or "skipped". A thread writes them to every output, all the events piled up meanwhile at once, so that
+    translating never waits for a slow console.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._render, daemon=True)
+        self._thread.start()
+
+    def emit(self, event):
+        self._events.put(event)
+
+    def close(self):
+        # Write the events still queued, then close the outputs.
+        self._events.put(None)
+        self._thread.join()
+
+    def _render(self):
+        while True:
+            events = [self._events.get()]
+            while True:
+                try:
+                    events.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in events
+            events = [event for event in events if event is not None]
+            for output in self.outputs:
+                try:
+                    with metrics.timer('render'):
+                        output.write(events)
+                except Exception as e:
+                    logger.error('Failed to render to {}: {}'.format(type(output).__name__, e))
+            if closing:
+                for output in self.outputs:
+                    output.close()
+                return
+
+
+def create_renderer(output='terminal'):
+    # `output` is a comma separated list of "terminal", "json" for JSON lines on stdout, "json:file" to append them to
+    # a file, and "overlay:file".
+    outputs = []
+    for spec in filter(None, output.split(',')):
+        kind, _, path = spec.partition(':')
+        if kind == 'terminal' and not path:
+            outputs.append(TerminalOutput())
+        elif kind == 'json':
+            outputs.append(JsonLinesOutput(open(path, 'a', encoding='utf-8') if path else sys.stdout))
+        elif kind == 'overlay' and path:
+            outputs.append(OverlayOutput(path))
+        else:
+            logger.error('--output option "{}" is not supported.'.format(spec))
+            exit(1)
+    return Renderer(outputs)
+# endregion
+
+
+# region main loop
+# Sentences of a paste are sent from a worker of the main loop's executor, so their requests have a pool of their own.
+sentence_executor = ThreadPoolExecutor(max_workers=pool_size)
+
+
+class Job:
+    """
+    Translations of one paste. A newer paste sets `cancelled` so that its queued requests are dropped, while results
+    already finished are still saved.
+    """
+
+    def __init__(self, paste, entry, source, roma_text, results, pending, timeouts=None, copied=None, sentences=None,
+                 exact=True):
+        self.paste = paste
+        # [(sentence, its entry in the log or a new one)] if the paste is translated sentence by sentence.
+        self.sentences = sentences
+        self.segments = {}  # engine => translation of each sentence
+        self.copied = copied  # perf_counter() when the paste was detected.
+        self.first_result = None
+        self.entry = entry  # Entry already in the log, if any.
+        self.exact = exact  # Whether `entry` is of the paste itself, or a fuzzy match of a similar one.
+        self.source = source
+        self.roma_text = roma_text
+        self.results = results  # engine => translation
+        self.pending = set(pending)
+        self.expired = set()  # Engines no longer waited for, whose late results are still saved.
+        self.cancelled = threading.Event()
+        self.timeouts = dict(timeouts or {})  # engine => seconds it is waited for
+        self.deadlines = {engine: time.monotonic() + timeout for engine, timeout in self.timeouts.items()}
+        self.shown = False  # Whether the result has been shown and closed by a line, before all engines answered.
+
+    @property
+    def deadline(self):
+        # The earliest deadline of the engines still pending, if any.
+        deadlines = [self.deadlines[engine] for engine in self.pending if engine in self.deadlines]
+        return min(deadlines) if deadlines else None
+
+    def expire(self):
+        # Stop waiting for the engines past their deadline, their results are None until they arrive. Return them.
+        now = time.monotonic()
+        expired = [engine for engine in self.pending if engine in self.deadlines and self.deadlines[engine] <= now]
+        for engine in expired:
+            self.pending.discard(engine)
+            self.expired.add(engine)
+            self.results[engine] = None
+        return expired
+
+    def save(self, log):
+        # Keep translations of engines that are not used this time. Those of a fuzzy match are of another paste, and
+        # not saved under this one, so that they are neither taken for its own nor matched again. An entry found in
+        # the log or a pack is not written again, unless something new is added to it.
+        if self.exact:
+            entry = dict(self.entry or {})
+            entry.update(self.results)
+            changed = self.entry is None or any(self.entry.get(key) != value for key, value in entry.items()
+                                                if value is not None)
+        else:
+            entry = {name: result for name, result in self.results.items() if self.entry.get(name) is None}
+            changed = any(result is not None for result in entry.values())
+        entry['source'] = self.source
+        entry['romkan'] = self.roma_text
+        with metrics.timer('log_write'):
+            if changed:
+                log[self.paste] = entry
+            for i, (sentence, sentence_entry) in enumerate(self.sentences or []):
+                translated = {name: translations[i] for name, translations in list(self.segments.items())
+                              if translations[i] is not None and sentence_entry.get(name) is None}
+                if translated:
+                    sentence_entry.update(translated)
+                    log[sentence] = sentence_entry
+
+    def translate_sentences(self, engine):
+        # Translate the sentences missing from the log in one batch, or one request each at the same time for engines
+        # which do not batch, then join all of them in order.
+        translations = [entry.get(engine.name) for _, entry in self.sentences]
+        missing = [i for i, translation in enumerate(translations) if translation is None]
+        if missing:
+            texts = [self.sentences[i][0] for i in missing]
+            if engine.batching:
+                missing_translations = engine.translate_batch(texts, self.cancelled)
+            else:
+                futures = [engine.submit(sentence_executor, [text], self.cancelled) for text in texts]
+                missing_translations = [future.result()[0] for future in futures]
+            for i, translation in zip(missing, missing_translations):
+                translations[i] = translation
+        self.segments[engine.name] = translations
+        if None in translations:
+            return None  # Not saved for the whole paste, while the translated sentences are.
+        return ('' if engine.target.split('-')[0] in SPACELESS_LANGUAGES else ' ').join(translations)
+
+    def observe(self, finished):
+        # Record copy-to-first-result and, once `finished`, copy-to-all-results latency.
+        if self.copied is None:
+            return
+        period = time.perf_counter() - self.copied
+        if self.first_result is None:
+            self.first_result = period
+            metrics.observe('paste_to_first_result', period)
+        if finished:
+            metrics.observe('paste_to_all_results', period)
+
+
+def translate_job(job, engines, events, hedge=False):
+    # Translate with `engines` one after another and post each result.
+    for engine in engines:
+        if job.sentences is None:
+            translate = engine.translate_hedged if hedge else engine.translate
+            result = translate(job.paste, job.cancelled)
+        else:
+            result = job.translate_sentences(engine)
+        events.put(('result', job, engine.name, result))
+
+
+def lookup(profile, paste):
+    # Return the entry of the paste in the log, or of a similar one with "--fuzzy", how it was found and whether it is
+    # the paste's own.
+    entry = profile.log.get(paste)
+    if entry is not None or not profile.fuzzy:
+        return entry, 'from log', True
+    match = profile.log.fuzzy_get(paste, profile.fuzzy)
+    if match is None:
+        return None, 'from log', True
+    # Only translations are reused, the romkan is of the paste itself.
+    logger.debug('Fuzzy matched "{}" with a score of {:.3f}.'.format(match[0], match[2]))
+    return {name: match[1].get(name) for name in profile.engines}, 'from log, {:.0%} match'.format(match[2]), False
+
+
+def sentence_entries(profile, sentences):
+    # [(sentence, its entry in the log or a new one)] of a paste translated sentence by sentence.
+    segments = []
+    for text in sentences:
+        if profile.source == 'ja':
+            tokenized = tokenize(text)
+            new = {'source': tokenized.source, 'romkan': tokenized.romkan}
+        else:
+            new = {'source': text, 'romkan': None}
+        segments.append((text, profile.log.get(text) or new))
+    return segments
+
+
+def paste_sentences(profile, paste, emit):
+    # The sentences `paste` is translated by, or None if one is too long and the paste is skipped.
+    sentences = (split_sentences(paste) or [paste]) if profile.segment else [paste]
+    if max(len(sentence) for sentence in sentences) > profile.number:
+        logger.info(OVER_CHARACTERS.format(profile.number))
+        emit({'type': 'skipped', 'reason': OVER_CHARACTERS.format(profile.number)})
+        return None
+    return sentences
+
+
+def start_job(profile, paste, sentences, emit, copied=None, timeout=None, race=False, cache=None):
+    # Emit the source, romkan and the results already known of `paste`, from the log or `cache`, and return its job
+    # and the engines still to translate it. Each engine is waited for its own "<engine>_timeout", or `timeout` if
+    # given. In race mode, "done" follows the first result.
+    if profile.source == 'ja':
+        sentence = tokenize(paste) if len(sentences) == 1 else tokenize_sentences(paste, sentences)
+        source = sentence.source
+    else:
+        sentence = None
+        source = paste
+    emit({'type': 'source', 'paste': paste, 'text': source})
+    entry, from_log, exact = lookup(profile, paste)
+    if entry is not None and 'romkan' in entry:
+        roma_text = entry['romkan']
+        emit({'type': 'romkan', 'text': roma_text, 'from': from_log})
+    elif sentence is not None:
+        roma_text = sentence.romkan
+        emit({'type': 'romkan', 'text': roma_text, 'from': None})
+    else:
+        roma_text = None
+    results, pending = {}, []
+    for name, engine in profile.engines.items():
+        cached = cache.get((name, engine.source, engine.target, paste)) if cache is not None else None
+        if entry is not None and entry.get(name) is not None:
+            results[name] = entry[name]
+            emit({'type': 'result', 'engine': name, 'text': results[name], 'from': from_log})
+        elif name in profile.disable:
+            logger.info('The "--disable" option is set. Pass {} translate.'.format(name))
+            results[name] = None
+        elif cached is not None:
+            results[name] = cached
+            emit({'type': 'result', 'engine': name, 'text': cached, 'from': 'from cache'})
+        else:
+            pending.append(engine)
+    segments = sentence_entries(profile, sentences) if len(sentences) > 1 and pending else None
+    job = Job(paste, entry, source, roma_text, results, [engine.name for engine in pending],
+              {engine.name: engine.timeout or timeout for engine in pending} if timeout is not None else None, copied,
+              segments, exact)
+    if any(result is not None for result in results.values()):
+        job.observe(not pending)  # Results from the log are the first ones.
+        if race:
+            emit({'type': 'done'})
+            job.shown = True
+    return job, pending
+
+
+def take_result(profile, job, name, result, emit, race=False, cache=None):
+    # Record the result of engine `name` for `job`, and emit it unless the job has been shown already. In race mode,
+    # only the first translation is shown and the others are just saved, as are those of expired engines.
+    late = name in job.expired
+    if late:
+        job.expired.discard(name)
+    elif name in job.pending:
+        job.pending.discard(name)
+    else:
+        return
+    job.results[name] = result
+    if result is not None and cache is not None:
+        engine = profile.engines[name]
+        cache.put((name, engine.source, engine.target, job.paste), result,
+                  sys.getsizeof(job.paste) + sys.getsizeof(result))
+    if late or job.shown or (result is None and race):
+        return
+    event = {'type': 'result', 'engine': name, 'text': result, 'from': None}
+    emit(dict(event, first=True) if race else event)
+    job.observe(not job.pending)
+    if race:
+        emit({'type': 'done'})
+        job.shown = True
+
+
+def watch_clipboard(watcher, events):
+    while True:
+        try:
+            paste = watcher.wait()
+        except Exception as e:
+            # The clipboard may be held by another program for a moment, keep watching.
+            logger.warning('Failed to read the clipboard: {}'.format(e))
+            time.sleep(WATCH_RETRY_DELAY)
+            continue
+        if paste is not None:
+            events.put(('paste', paste, time.perf_counter()))
+
+
+def main_loop(profile, watcher=None, tts_worker=None, prefetcher=None, renderer=None):
+    watcher = watcher or create_watcher(profile)
+    # Results are emitted as events to be written by the renderer's own thread.
+    emit = (renderer or create_renderer(profile.output)).emit
+    # Clipboard changes and engine results arrive on the same queue, so that a newer paste pre-empts the current job.
+    events = queue.Queue()
+    threading.Thread(target=watch_clipboard, args=(watcher, events), daemon=True).start()
+    executor = ThreadPoolExecutor(max_workers=pool_size)
+    job = None
+    logger.debug(profile.print_config())
+    logger.info(START_MONITORING)
+    while True:
+        if prefetcher:
+            # Prefetching only uses the engines while no paste is waiting for them.
+            prefetcher.resume() if job is None else prefetcher.pause()
+        if job is not None and job.deadline is not None and time.monotonic() >= job.deadline:
+            for engine in job.expire():
+                logger.warning(ENGINE_TIMEOUT.format(engine, job.timeouts[engine]))
+            if not job.pending:
+                job.save(profile.log)
+                if not job.shown:
+                    emit({'type': 'done'})
+                job = None
+        # Wake up regularly so that KeyboardInterrupt is not blocked by the queue.
+        timeout = 0.5 if job is None or job.deadline is None else min(max(job.deadline - time.monotonic(), 0), 0.5)
+        try:
+            event = events.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        # region result
+        if event[0] == 'result':
+            _, finished, engine, result = event
+            take_result(profile, finished, engine, result, emit, profile.race)
+            if not finished.pending:
+                finished.save(profile.log)
+                if finished is job:
+                    if not job.shown:
+                        emit({'type': 'done'})
+                    job = None
+            continue
+        # endregion
+        paste, copied = event[1], event[2]
+        sentences = paste_sentences(profile, paste, emit)
+        if sentences is None:
+            continue
+        logger.debug('A different detected.')
+        if prefetcher:
+            prefetcher.advance(paste)
+        # region pre-empt
+        if job is not None:
+            job.cancelled.set()
+            job.save(profile.log)  # Save finished results now, late ones are saved when they arrive.
+            logger.debug('Previous paste superseded with {} engines pending.'.format(len(job.pending)))
+            if not job.shown:
+                emit({'type': 'done'})
+                job.shown = True  # Its late results are only saved.
+            job = None
+        # endregion
+        # region tts
+        if profile.voice:
+            if profile.match and re.search(profile.match, paste) or profile.match is None:
+                logger.debug('"{}" matches in paste. Continue...'.format(profile.match))
+                tts_worker.speak(paste, profile.voice, profile.source)
+            else:
+                logger.debug('"{}" does not match in paste. Pass...'.format(profile.match))
+        # endregion
+        # region translate engines
+        fan_out = profile.concurrent or profile.race
+        job, pending = start_job(profile, paste, sentences, emit, copied, profile.timeout if fan_out else None,
+                                 profile.race)
+        if not pending:
+            job.save(profile.log)
+            if not job.shown:
+                emit({'type': 'done'})
+            job = None
+        elif fan_out:
+            # Fan out to all pending engines, each result is emitted as soon as it arrives.
+            for engine in pending:
+                executor.submit(translate_job, job, [engine], events, profile.hedge)
+        else:
+            executor.submit(translate_job, job, pending, events, profile.hedge)
+        # endregion
+# endregion
+
+
+# region daemon
+# Options a request may set, as in the command line: a section of the config file, which is also all that a profile is
+# kept by, and how the engines are waited for. Logs, packs and engines are the daemon's or a section's own, so that no
+# request chooses the files written.
+DAEMON_SETTINGS = ('profile', 'timeout', 'race', 'hedge')
+# Options of a client's command line which only the daemon or a section of its config file set.
+DAEMON_IGNORED = ('log', 'encrypt', 'fuzzy', 'pack', 'disable', 'number', 'segment', 'source', 'target', 'engines',
+                  'concurrent')
+DAEMON_HOSTS = ('localhost', '127.0.0.1', '::1')  # Host headers always accepted, against DNS rebinding.
+translation_cache = LRUCache(cache_size, cache_memory)  # (engine, source, target, text) => translation
+
+
+class Daemon:
+    """
+    Translation service shared by thin clients over a local HTTP or Unix socket API.
+
+    Engine clients, MeCab and the caches are created once per process, so they are shared by every profile the daemon
+    hosts, and so is `translation_cache`. A profile is created on the first request for a section of the config
+    file, or for none to use the daemon's command line, and kept with its log from then on. Engines of a request are
+    always queried at the same time, each result being streamed as soon as it arrives.
+    """
+
+    def __init__(self, args):
+        self._args = args
+        self._profiles = {}  # section => Profile
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.requests = 0
+
+    # region public functions
+    def profile(self, settings):
+        unknown = set(settings) - set(DAEMON_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown settings: {}'.format(', '.join(sorted(unknown))))
+        timeout = settings.get('timeout', 1)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not timeout > 0 or \
+                not all(isinstance(settings.get(name, False), bool) for name in ('race', 'hedge')):
+            raise ValueError('Invalid settings: {}'.format(json.dumps(settings, ensure_ascii=False)))
+        section = settings.get('profile', self._args.profile)
+        with self._lock:
+            profile = self._profiles.get(section)
+            if profile is None:
+                args = argparse.Namespace(**vars(self._args))
+                args.profile = section
+                try:
+                    # Budgets are the daemon's own for all its profiles.
+                    profile = create_profile(args, configure=not self._profiles, local=False)
+                except SystemExit:
+                    raise ValueError('Invalid settings: {}'.format(json.dumps(settings, ensure_ascii=False)))
+                self._profiles[section] = profile
+        return profile
+
+    def translate(self, settings, paste, emit):
+        # Call `emit` with each event of the translation of `paste`: "source", "romkan", then "result" of each
+        # engine, and "done", or "skipped" if the paste is too long. In race mode, "done" follows the first result and
+        # the others are only saved. The other settings of the request apply to it alone.
+        profile = self.profile(settings)
+        race = settings.get('race', profile.race)
+        hedge = settings.get('hedge', profile.hedge)
+        timeout = settings.get('timeout', profile.timeout)
+        self.requests += 1
+        copied = time.perf_counter()
+        sentences = paste_sentences(profile, paste, emit)
+        if sentences is None:
+            return
+        job, pending = start_job(profile, paste, sentences, emit, copied, timeout, race, translation_cache)
+        events = queue.Queue()
+        for engine in pending:
+            self._executor.submit(translate_job, job, [engine], events, hedge)
+        try:
+            while job.pending:
+                try:
+                    _, _, name, result = events.get(timeout=max(job.deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    for name in job.expire():
+                        logger.warning(ENGINE_TIMEOUT.format(name, job.timeouts[name]))
+                    continue
+                take_result(profile, job, name, result, emit, race, translation_cache)
+        finally:
+            # Also when the client has gone away, finished results are saved.
+            job.cancelled.set()
+            job.save(profile.log)
+            if job.expired:
+                threading.Thread(target=self._save_late, args=(profile, job, events), daemon=True).start()
+        if not job.shown:
+            emit({'type': 'done'})
+
+    @staticmethod
+    def _save_late(profile, job, events):
+        # Save the results of expired engines as they arrive, after the request has been answered.
+        while job.expired:
+            _, _, name, result = events.get()
+            take_result(profile, job, name, result, lambda event: None, cache=translation_cache)
+            job.save(profile.log)
+
+    def batch(self, settings, lines, size=32):
+        batch(self.profile(settings), lines, size)
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self._profiles.values())
+        return {'requests': self.requests,
+                'profiles': [{'log': profile.log_filename, 'engines': {name: engine.stats() for name, engine
+                                                                       in profile.engines.items()},
+                              'log_flush': profile.log.stats()} for profile in profiles],
+                'caches': {'sentence': sentence_cache.stats(), 'romaji': roma_cache.stats(),
+                           'translation': translation_cache.stats()},
+                'budgets': scheduler.usage(),
+                'stages': json.loads(metrics.to_json())}
+
+    def close(self):
+        with self._lock:
+            for profile in self._profiles.values():
+                profile.save_log()
+        self._executor.shutdown(wait=False)
+    # endregion
+
+
+def create_daemon_server(daemon, host='127.0.0.1', port=DAEMON_PORT, socket_path=None):
+    # POST /translate streams the events of a paste as JSON lines, POST /batch translates many lines into the log,
+    # GET /stats and GET /metrics report what the daemon has done.
+    import http.server
+    import socketserver
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self._allowed():
+                return
+            if self.headers.get_content_type() != 'application/json':
+                # Web pages cannot send JSON to another origin without a preflight, which is not answered.
+                self._reply(415, {'error': 'Content-Type must be application/json.'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                settings = {name: value for name, value in body.items() if name not in ('text', 'texts', 'batch_size')}
+                if self.path == '/translate':
+                    text = body['text']
+                    daemon.profile(settings)  # Fail before the response has started.
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+                    self.end_headers()
+                    daemon.translate(settings, text, self._emit)
+                elif self.path == '/batch':
+                    daemon.batch(settings, body['texts'], body.get('batch_size', 32))
+                    self._reply(200, {'lines': len(body['texts'])})
+                else:
+                    self._reply(404, {'error': 'Not found.'})
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self._reply(400, {'error': str(e)})
+            except (BrokenPipeError, ConnectionResetError):
+                logger.debug('A client has gone away.')
+
+        def do_GET(self):
+            if not self._allowed():
+                return
+            if self.path == '/stats':
+                self._reply(200, daemon.stats())
+            elif self.path == '/metrics':
+                self._reply(200, metrics.to_prometheus(scheduler.usage()), 'text/plain; version=0.0.4')
+            else:
+                self._reply(404, {'error': 'Not found.'})
+
+        def _allowed(self):
+            # Refuse a Host header other than the daemon's own, as sent by a web page to a rebound domain name. Unix
+            # sockets are out of reach of web pages, and so is a daemon listening on all addresses anyway.
+            if socket_path or host in ('', '0.0.0.0', '::'):
+                return True
+            name = urllib.parse.urlsplit('//' + self.headers.get('Host', '')).hostname
+            if name in DAEMON_HOSTS or name == host.lower():
+                return True
+            self._reply(403, {'error': 'Host not allowed.'})
+            return False
+
+        def _emit(self, event):
+            self.wfile.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+        def _reply(self, status, body, content_type='application/json'):
+            data = (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else socket_path
+
+        def log_message(self, format, *args):
+            logger.debug('{} {}'.format(self.address_string(), format % args))
+
+    if socket_path:
+        class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # Left by a daemon which did not exit normally.
+        return UnixServer(socket_path, Handler)
+    return http.server.ThreadingHTTPServer((host, port), Handler)
+
+
+def daemon_request(url, path, body=None):
+    # Send `body` as JSON to the daemon at `url`, "http://host:port" or "unix:/path/to/socket", or GET `path` without
+    # a body, and return the response.
+    import http.client
+    import socket
+
+    class UnixConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(url[len('unix:'):])
+
+    if url.startswith('unix:'):
+        connection = UnixConnection('localhost')
+    else:
+        parts = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port or DAEMON_PORT)
+    if body is None:
+        connection.request('GET', path)
+    else:
+        connection.request('POST', path, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'})
+    return connection.getresponse()
+
+
+def daemon_settings(args):
+    # Settings of the command line which differ from the defaults, the daemon's own apply to the others.
+    ignored = [name for name in DAEMON_IGNORED if getattr(args, name) != parser.get_default(name)]
+    if ignored:
+        logger.warning('Options {} are set by the daemon or the sections of its config file, and ignored.'.format(
+            ', '.join('--' + name for name in ignored)))
+    return {name: getattr(args, name) for name in DAEMON_SETTINGS if getattr(args, name) != parser.get_default(name)}
+
+
+def render_remote(url, body, finished, renderer):
+    # Pass the events of a paste streamed by the daemon to `renderer`, until `finished` is set by a newer paste.
+    try:
+        response = daemon_request(url, '/translate', body)
+    except OSError as e:
+        logger.error(DAEMON_UNREACHABLE.format(url, e))
+        return
+    if response.status != 200:
+        logger.error(json.loads(response.read().decode('utf-8'))['error'])
+        return
+    with response:
+        for line in response:
+            if finished.is_set():
+                return
+            event = json.loads(line.decode('utf-8'))
+            if event['type'] == 'skipped':
+                logger.info(event['reason'])
+                renderer.emit(event)
+                return
+            if event['type'] == 'done':
+                break
+            renderer.emit(event)
+    if not finished.is_set():
+        finished.set()
+        renderer.emit({'type': 'done'})
+
+
+def client_loop(args, url, watcher=None, tts_worker=None, renderer=None):
+    # Watch the clipboard and have the daemon at `url` translate each paste.
+    watcher = watcher or create_watcher(args)
+    renderer = renderer or create_renderer(args.output)
+    events = queue.Queue()
+    threading.Thread(target=watch_clipboard, args=(watcher, events), daemon=True).start()
+    settings, finished = daemon_settings(args), None
+    logger.info(START_MONITORING)
+    while True:
+        try:
+            paste = events.get(timeout=0.5)[1]  # Wake up regularly so that KeyboardInterrupt is not blocked.
+        except queue.Empty:
+            continue
+        if finished is not None and not finished.is_set():
+            finished.set()
+            renderer.emit({'type': 'done'})
+        finished = threading.Event()
+        if tts_worker and (args.match is None or re.search(args.match, paste)):
+            tts_worker.speak(paste, args.voice, args.source)
+        threading.Thread(target=render_remote, args=(url, dict(settings, text=paste), finished, renderer),
+                         daemon=True).start()
+# endregion
+
+
+# region fuzzy match
+def normalize(text):
+    # Drop what text hooks vary in: width, whitespace, furigana, repeated characters or lines and end punctuation.
+    # Only runs of 3 characters or more are collapsed, as words such as "ええ" or "ここ" double theirs.
+    text = unicodedata.normalize('NFKC', text)
+    text = FURIGANA.sub('', text)
+    text = ''.join(text.split())
+    text = re.sub(r'(.)\1{2,}', r'\1', text)
+    repeated = re.fullmatch(r'(.{2,}?)\1+', text)
+    if repeated:
+        text = repeated.group(1)
+    return text.rstrip(TRAILING_PUNCTUATION).strip(QUOTES).rstrip(TRAILING_PUNCTUATION)
+
+
+def minhash_bands(normalized):
+    # Values of each band of the MinHash signature of the character bigrams. Each bigram is hashed once into one of
+    # the bins, and an empty bin borrows the value of the next bin which is not.
+    bins = FUZZY_BANDS * FUZZY_ROWS
+    signature = [None] * bins
+    for i in range(max(len(normalized) - 1, 1)):
+        value = zlib.crc32(normalized[i:i+2].encode('utf-8'))
+        index, value = value % bins, value // bins
+        if signature[index] is None or value < signature[index]:
+            signature[index] = value
+    if signature.count(None) < bins:
+        hashed = list(signature)
+        for index in range(bins):
+            offset = 1
+            while signature[index] is None:
+                borrowed = hashed[(index + offset) % bins]
+                if borrowed is not None:
+                    signature[index] = (borrowed, offset)
+                offset += 1
+    return [signature[i:i+FUZZY_ROWS] for i in range(0, bins, FUZZY_ROWS)]
+
+
+def bigrams(normalized):
+    return {normalized[i:i+2] for i in range(max(len(normalized) - 1, 1))}
+
+
+def similarity(grams, other_grams):
+    # Dice coefficient of two bigram sets, from 0 to 1.
+    return 2 * len(grams & other_grams) / (len(grams) + len(other_grams))
+# endregion
+
+
+# region log store
+# a.b.json => a.b.db
+def log_store_filename(filepath):
+    path, ext = os.path.splitext(filepath)
+    return filepath if ext == LOG_STORE_EXT else path+LOG_STORE_EXT
+
+
+def pack_entry(paste, entry):
+    # Entry => log record, [source, romkan, {engine: translation}] without missing translations. The source is stored
+    # as the offsets of the spaces put into the paste between its morphemes, when it is just that.
+    if not isinstance(entry.get('source'), str) or 'romkan' not in entry:
+        return entry
+    source = entry['source']
+    if ' ' not in paste and source.replace(' ', '') == paste and '  ' not in source and source.strip(' ') == source:
+        offsets, position = [], 0
+        for token in source.split(' ')[:-1]:
+            position += len(token)
+            offsets.append(position)
+        source = offsets
+    return [source, entry['romkan'], {name: translation for name, translation in entry.items()
+                                      if name not in ('source', 'romkan') and translation is not None}]
+
+
+def unpack_entry(paste, packed):
+    # Log record => entry, records of older versions are entries as they are.
+    if isinstance(packed, dict):
+        return packed
+    source, romkan, translations = packed
+    if isinstance(source, list):
+        source = ' '.join(paste[start:end] for start, end in zip([0] + source, source + [len(paste)]))
+    return dict(source=source, romkan=romkan, **translations)
+
+
+class LogStore:
+    """
+    Translation log in a SQLite database keyed by paste text.
+
+    Entries set are kept in a dirty buffer, which a background thread flushes in one transaction every
+    `flush_interval` seconds or as soon as `flush_entries` are pending, so that neither a crash loses more than that
+    nor the main loop waits for the disk. Flushes go through a second connection, which WAL lets write while the
+    first one reads. The database is opened on first access. With `fuzzy`, the "fuzzy" table indexes the normalized
+    text and the MinHash bands of each paste, and is kept up to date from then on.
+    """
+
+    # region type hints
+    _filename: str
+    _connection: sqlite3.Connection
+    _writer: sqlite3.Connection
+    _lock: threading.Lock
+    _write_lock: threading.Lock
+    _dirty: OrderedDict
+    _flushing: OrderedDict
+    _fuzzy: bool
+    _indexed: bool
+    # endregion
 
+    # region constructor and destructor
+    def __init__(self, filename, fuzzy=False, flush_interval=log_flush_interval, flush_entries=log_flush_entries):
+        self._filename = filename
+        self._connection = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._fuzzy = fuzzy
+        self._indexed = False
+        self._dirty = OrderedDict()  # paste => entry, not flushed yet
+        self._flushing = OrderedDict()  # paste => entry, being flushed
+        self._dirty_changed = threading.Condition()
+        self._flush_interval = flush_interval
+        self._flush_entries = flush_entries
+        self._checkpointer = None
+        self._closed = False
+        self._flushes = 0
+        self._flushed_entries = 0
+        self._flushed_bytes = 0
+        self._packs = []  # Read-only TranslationPacks under the log, the last one first.
 
-def aws_translate(text, target='en', source='ja'):
-    start_time = datetime.now()
-    result_dict = aws_client.translate_text(Text=text,
-                                            SourceLanguageCode=source,
-                                            TargetLanguageCode=target)
-    period = (datetime.now() - start_time).seconds
-    logger.debug('AWS finished API request in {} seconds'.format(period))
-    if period > API_TOLERATED_DELAY:
-        logger.info(REQUEST_FINISHED_IN.format('AWS', period))
-    r = result_dict.get('TranslatedText', None)
-    if r == None:
-        logger.error(AWS_API_ERROR.format(str(result_dict)))
-        return None
-    else:
-        return r
+    def __repr__(self):
+        return '{}("{}")'.format(type(self).__name__, self._filename)
+    # endregion
 
+    # region private functions
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self._filename, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS log (paste TEXT PRIMARY KEY, entry TEXT NOT NULL)')
+            self._open(connection)
+            self._indexed = bool(connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'fuzzy'").fetchone())
+            if self._indexed and connection.execute('PRAGMA user_version').fetchone()[0] < FUZZY_VERSION:
+                connection.execute('DROP TABLE fuzzy')
+                self._indexed = False
+            if self._fuzzy and not self._indexed:
+                self._build_index(connection)
+            connection.commit()
+            self._connection = connection
+        return self._connection
 
-def google_translate(text, target='zh-CN', source='ja'):
-    response = client.translate_text(parent=parent, contents=[text], mime_type='text/plain', source_language_code=source, target_language_code=target)
-    try:
-        r = response.translations[0].translated_text
-    except Exception:
-        logger.log(GOOGLE_API_ERROR.format(str(response)))
-        return None
-    else:
-        return r
-# endregion
+    def _connect_writer(self):
+        # Opened after the reader, which has created the tables and checked the password.
+        if self._writer is None:
+            with self._lock:
+                self._connect()
+            self._writer = sqlite3.connect(self._filename, check_same_thread=False)
+        return self._writer
 
+    def _write(self, items):
+        # Write (paste, entry) pairs in one transaction, returning the bytes of the rows written. The caller holds
+        # the write lock. An entry that cannot be serialized is dropped, so that it does not block the others.
+        rows = []
+        for paste, entry in items:
+            try:
+                rows.append((paste, self._dump(paste, entry)))
+            except (TypeError, ValueError) as e:
+                logger.error('Dropped the log entry of "{}", which cannot be saved: {}'.format(paste, e))
+        connection = self._connect_writer()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO log VALUES (?, ?)', (row for _, row in rows))
+            if self._indexed:
+                for paste, row in rows:
+                    rowid = connection.execute('SELECT rowid FROM log WHERE paste = ?', row[:1]).fetchone()[0]
+                    self._index(connection, rowid, paste)
+        return sum(len(value) + len(key) for _, (key, value) in rows)
 
-# region crypto
-def align(value):
-    if isinstance(value, str):
-        value = value.encode('ascii')
-    elif isinstance(value, bytes):
-        pass
-    else:
-        logger.critical('align() only accept str and bytes.')
-        exit(1)
-    while len(value) % 16 != 0:
-        value += b' '
-    return value
+    def _checkpoint(self):
+        while True:
+            with self._dirty_changed:
+                if not self._closed and len(self._dirty) < self._flush_entries:
+                    self._dirty_changed.wait(self._flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:  # The thread must outlive any failed flush, or nothing is saved any more.
+                logger.error('Failed to flush log "{}": {}'.format(self._filename, e))
 
+    def _build_index(self, connection):
+        # Pastes are indexed by the rowid of the log table. A replaced entry gets a new rowid, which is indexed again,
+        # while the old one just matches nothing.
+        connection.execute('CREATE TABLE fuzzy (hash INTEGER NOT NULL, id INTEGER NOT NULL, UNIQUE (hash, id))')
+        connection.execute('PRAGMA user_version = {}'.format(FUZZY_VERSION))
+        self._indexed = True
+        count = connection.execute('SELECT COUNT(*) FROM log').fetchone()[0]
+        if count:
+            logger.info(BUILDING_FUZZY_INDEX.format(count, self._filename))
+            for rowid, key, value in connection.execute('SELECT rowid, paste, entry FROM log'):
+                self._index(connection, rowid, self._load(key, value)[0])
 
-def encrypt(ascii_safe_text, key):
-    # str => bytes
-    assert isinstance(ascii_safe_text, str)
-    aes = AES.new(align(key), AES.MODE_ECB)
-    return aes.encrypt(align(ascii_safe_text))
+    def _index(self, connection, rowid, paste):
+        connection.executemany('INSERT OR IGNORE INTO fuzzy VALUES (?, ?)',
+                               ((digest, rowid) for digest in self._fuzzy_hashes(normalize(paste))))
 
+    def _fuzzy_hashes(self, normalized, bands=True):
+        # The normalized text itself, then each MinHash band.
+        values = [b'n' + normalized.encode('utf-8')]
+        if bands:
+            values += [bytes([i]) + repr(band).encode('ascii') for i, band in enumerate(minhash_bands(normalized))]
+        return [self._digest(value) for value in values]
 
-def decrypt(cipher, key):
-    # bytes => str
-    assert isinstance(cipher, bytes)
-    aes = AES.new(align(key), AES.MODE_ECB)
-    return aes.decrypt(align(cipher)).decode('ascii').rstrip()
+    def _digest(self, value):
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big', signed=True)
 
+    def _open(self, connection):
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'meta'").fetchone():
+            logger.error(PASSWORD_NOT_SPECIFIED.format(self._filename))
+            exit(1)
 
-# a.b.txt => a.b(insert_text).txt
-# Or abc => abc(insert_text) if dot not found
-def rename(filepath, insert_text):
-    path, ext = os.path.splitext(filepath)
-    return path+insert_text+ext
+    def _key(self, paste):
+        return paste
 
+    def _dump(self, paste, entry):
+        # => row of the log table
+        return paste, json.dumps(pack_entry(paste, entry), ensure_ascii=False, separators=(',', ':'))
 
-def passwd(filepath):
-    if not os.path.isfile(filepath):
-        logger.error(FILE_NOT_FOUND.format(filepath))
-        exit(1)
-    target = input(CHOOSE_A_TARGET)
-    if target == 'C':
-        old_password = getpass.getpass(INPUT_OLD_PASSWORD)
-        with open(filepath, 'rb') as f:
+    def _load(self, key, value):
+        # row of the log table => (paste, entry)
+        return key, unpack_entry(key, json.loads(value))
+    # endregion
+
+    # region mapping protocol
+    def __contains__(self, paste):
+        return self.get(paste) is not None
+
+    def __getitem__(self, paste):
+        entry = self.get(paste)
+        if entry is None:
+            raise KeyError(paste)
+        return entry
+
+    def __setitem__(self, paste, entry):
+        entry = dict(entry)  # A copy, the caller may go on changing its own while it is being flushed.
+        with self._dirty_changed:
+            self._dirty.pop(paste, None)
+            self._dirty[paste] = entry
+            if self._checkpointer is None:
+                self._checkpointer = threading.Thread(target=self._checkpoint, daemon=True)
+                self._checkpointer.start()
+            if len(self._dirty) >= self._flush_entries:
+                self._dirty_changed.notify()
+
+    def __len__(self):
+        self.flush()
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM log').fetchone()[0]
+
+    def __iter__(self):
+        return (paste for paste, _ in self.items())
+
+    def get(self, paste, default=None):
+        with self._dirty_changed:
+            entry = self._dirty.get(paste) or self._flushing.get(paste)
+        if entry is not None:
+            return dict(entry)  # Changes are only buffered when set again.
+        key = self._key(paste)
+        with self._lock:
+            row = self._connect().execute('SELECT paste, entry FROM log WHERE paste = ?', (key, )).fetchone()
+        if row is not None:
+            return self._load(*row)[1]
+        for pack in self._packs:
+            entry = pack.get(paste)
+            if entry is not None:
+                return entry
+        return default
+
+    def items(self, chunk_size=1000):
+        # Rows are read `chunk_size` at a time, so that a large log is never held in memory at once.
+        self.flush()
+        with self._lock:
+            cursor = self._connect().execute('SELECT paste, entry FROM log')
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self._load(*row)
+    # endregion
+
+    # region public functions
+    def attach(self, pack):
+        # Layer a TranslationPack under the log, over the ones attached before. Entries of the log come first, and
+        # only the log itself is iterated, counted and indexed for fuzzy lookups.
+        self._packs.insert(0, pack)
+
+    def update(self, log):
+        # Insert all entries in one transaction right away, used by migration and batch.
+        with self._write_lock:
+            self._write(log.items() if isinstance(log, dict) else log)
+
+    def flush(self):
+        # Write the dirty entries in one transaction. They stay readable from the buffer until it is committed.
+        with self._write_lock:
+            with self._dirty_changed:
+                if not self._dirty:
+                    return
+                self._flushing, self._dirty = self._dirty, OrderedDict()
+            start_time = time.perf_counter()
             try:
-                log = json.loads(decrypt(f.read(), old_password))
-            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                logger.error(WRONG_PASSWORD.format(filepath))
-                exit(1)
-        new_password = getpass.getpass(INPUT_NEW_PASSWORD)
-        new_filepath = rename(filepath, '(encrypted)')
-        logger.info(SAVING_TO_PLEASE_WAIT.format(new_filepath))
-        with open(new_filepath, 'wb') as f:
-            f.write(encrypt(json.dumps(log), new_password))
-        logger.info(DONE)
-    elif target == 'E':
-        with open(filepath, 'r') as f:
+                size = self._write(self._flushing.items())
+            except BaseException:
+                with self._dirty_changed:
+                    self._flushing.update(self._dirty)
+                    self._dirty, self._flushing = self._flushing, OrderedDict()
+                raise
+            period = time.perf_counter() - start_time
+            with self._dirty_changed:
+                count, self._flushing = len(self._flushing), OrderedDict()
+            self._flushes += 1
+            self._flushed_entries += count
+            self._flushed_bytes += size
+        metrics.observe('log_flush', period)
+        logger.debug('Flushed {} entries ({} bytes) to "{}" in {:.3f} seconds.'.format(count, size, self._filename,
+                                                                                     period))
+
+    def stats(self):
+        return {'flushes': self._flushes, 'entries': self._flushed_entries, 'bytes': self._flushed_bytes,
+                'pending': len(self._dirty)}
+
+    def fuzzy_get(self, paste, threshold):
+        # Return (paste, entry, score) of the most similar paste scoring at least `threshold`, or None. A paste with
+        # the same normalized text is found first, or else candidates sharing a MinHash band are scored.
+        normalized = normalize(paste)
+        with self._lock:
+            connection = self._connect()
+            if not self._indexed:
+                return None
+            ids = [rowid for rowid, in connection.execute('SELECT id FROM fuzzy WHERE hash = ?',
+                                                          self._fuzzy_hashes(normalized, bands=False))]
+            if not ids:
+                bands = self._fuzzy_hashes(normalized)[1:]
+                postings = ' UNION ALL '.join(['SELECT * FROM (SELECT id FROM fuzzy WHERE hash = ? LIMIT {})'.format(
+                    FUZZY_POSTINGS)] * len(bands))
+                ids = [rowid for rowid, in connection.execute(
+                    'SELECT id FROM ({}) GROUP BY id ORDER BY COUNT(*) DESC LIMIT {}'.format(
+                        postings, FUZZY_CANDIDATES), bands)]
+            rows = connection.execute('SELECT paste, entry FROM log WHERE rowid IN ({})'.format(
+                ', '.join('?' * len(ids))), ids).fetchall()
+        with self._dirty_changed:
+            pending = list(self._flushing.items()) + list(self._dirty.items())
+        best, grams, raw_grams = None, bigrams(normalized), None
+        for other, entry in itertools.chain((self._load(*row) for row in rows), pending):
+            other_normalized = normalize(other)
+            if other_normalized == normalized:
+                # Still scored, on the text with only width and whitespace normalized, so that the threshold holds for
+                # the furigana, repeated characters and end punctuation which normalizing dropped.
+                raw_grams = raw_grams or bigrams(''.join(unicodedata.normalize('NFKC', paste).split()))
+                score = similarity(raw_grams, bigrams(''.join(unicodedata.normalize('NFKC', other).split())))
+            else:
+                score = similarity(grams, bigrams(other_normalized))
+            if score >= threshold and (best is None or score > best[2]):
+                best = (other, entry, score)
+        return best
+
+    def copy_from(self, items, chunk_size=1000):
+        # Copy (paste, entry) pairs from another log one chunk at a time.
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                self.update(chunk)
+                chunk = []
+        self.update(chunk)
+
+    def migrate(self, json_filepath):
+        logger.info(MIGRATING_LOG.format(json_filepath, self._filename))
+        with open(json_filepath, 'r') as f:
             try:
-                log = json.loads(f.read())
+                self.update(json.loads(f.read()))
             except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                logger.error(PASSWORD_NOT_SPECIFIED.format(filepath))
+                logger.error(PASSWORD_NOT_SPECIFIED.format(json_filepath))
                 exit(1)
-        new_filepath = rename(filepath, '(encrypted)')
-        password = getpass.getpass(INPUT_PASSWORD_TO_ENCRYPT.format(filepath))
-        logger.info(SAVING_TO_PLEASE_WAIT.format(new_filepath))
-        with open(new_filepath, 'wb') as f:
-            f.write(encrypt(json.dumps(log), password))
         logger.info(DONE)
-    elif target == 'D':
-        password = getpass.getpass(INPUT_PASSWORD_TO_DECRYPT.format(filepath))
-        with open(filepath, 'rb') as f:
-            try:
-                log = json.loads(decrypt(f.read(), password))  # Still need to be json.loads to validate password.
-            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                logger.error(WRONG_PASSWORD.format(filepath))
+
+    def close(self):
+        # Stop the checkpointer and flush what is left.
+        with self._dirty_changed:
+            self._closed = True
+            self._dirty_changed.notify()
+        if self._checkpointer is not None:
+            self._checkpointer.join()
+            self._checkpointer = None
+        self.flush()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+        for pack in self._packs:
+            pack.close()
+        self._packs = []
+    # endregion
+
+
+class EncryptedLogStore(LogStore):
+    """
+    Translation log encrypted record by record.
+
+    Keys are derived once from the password with PBKDF2. Each paste is looked up by its HMAC-SHA256, and each record
+    is the paste and its entry sealed with AES-GCM, bound to that HMAC, so that records are appended and decrypted
+    one by one. The salt and a sealed check value to verify the password are kept in the "meta" table.
+    """
+
+    # region constructor and destructor
+    def __init__(self, filename, password, fuzzy=False, **kwargs):
+        super().__init__(filename, fuzzy, **kwargs)
+        self._password = password
+        self._cipher_key = None
+        self._mac_key = None
+    # endregion
+
+    # region private functions
+    def _open(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        meta = dict(connection.execute('SELECT name, value FROM meta').fetchall())
+        if not meta:
+            if connection.execute('SELECT 1 FROM log LIMIT 1').fetchone():
+                logger.error('"{}" is not encrypted.'.format(self._filename))
                 exit(1)
-        new_filepath = rename(filepath, '(decrypted)')
-        logger.info(SAVING_TO_PLEASE_WAIT.format(new_filepath))
-        with open(new_filepath, 'w') as f:
-            f.write(json.dumps(log))
+            meta = {'salt': os.urandom(16), 'iterations': LOG_KDF_ITERATIONS}
+        self._derive(meta['salt'], int(meta['iterations']))
+        if 'check' not in meta:
+            meta['check'] = self._seal(LOG_CHECK_VALUE, b'check')
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+        elif self._unseal(meta['check'], b'check') != LOG_CHECK_VALUE:
+            logger.error(WRONG_PASSWORD.format(self._filename))
+            exit(1)
+
+    def _derive(self, salt, iterations):
+        keys = hashlib.pbkdf2_hmac('sha256', self._password.encode('utf-8'), salt, iterations, dklen=64)
+        self._cipher_key, self._mac_key = keys[:32], keys[32:]
+
+    def _seal(self, plaintext, associated):
+        from Crypto.Cipher import AES
+        aes = AES.new(self._cipher_key, AES.MODE_GCM)
+        aes.update(associated)
+        ciphertext, tag = aes.encrypt_and_digest(plaintext)
+        return aes.nonce + tag + ciphertext
+
+    def _unseal(self, record, associated):
+        # Return None if the record is not authentic.
+        from Crypto.Cipher import AES
+        aes = AES.new(self._cipher_key, AES.MODE_GCM, nonce=record[:16])
+        aes.update(associated)
+        try:
+            return aes.decrypt_and_verify(record[32:], record[16:32])
+        except ValueError:
+            return None
+
+    def _digest(self, value):
+        # Keyed, so that the index does not reveal which pastes are alike without the password.
+        digest = hashlib.blake2b(value, digest_size=8, key=self._mac_key).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    def _key(self, paste):
+        if self._mac_key is None:
+            with self._lock:
+                self._connect()
+        return hmac.new(self._mac_key, paste.encode('utf-8'), hashlib.sha256).digest()
+
+    def _dump(self, paste, entry):
+        key = self._key(paste)
+        record = json.dumps([paste, pack_entry(paste, entry)], ensure_ascii=False, separators=(',', ':'))
+        return key, self._seal(record.encode('utf-8'), key)
+
+    def _load(self, key, value):
+        plaintext = self._unseal(value, key)
+        if plaintext is None:
+            logger.error(WRONG_PASSWORD.format(self._filename))
+            exit(1)
+        paste, packed = json.loads(plaintext.decode('utf-8'))
+        return paste, unpack_entry(paste, packed)
+    # endregion
+
+    # region public functions
+    def check_password(self):
+        # Open the database now, which exits on a wrong password.
+        with self._lock:
+            self._connect()
+
+    def migrate(self, legacy_filepath):
+        # Legacy encrypted logs are a single AES-ECB blob of the whole JSON.
+        logger.info(MIGRATING_LOG.format(legacy_filepath, self._filename))
+        self.update(load_legacy_log(legacy_filepath, self._password))
         logger.info(DONE)
-    else:
-        logger.error(INVALID_TARGET.format(target))
-        exit(1)
+    # endregion
+
+
+class TranslationPack:
+    """
+    Read-only translation memory in a single file, built from logs with "cp2trans pack" to be shared.
+
+    The file is memory-mapped and nothing is read up front but its header, so it opens in the same time whatever its
+    size. A paste is looked up by a binary search of the sorted 64-bit hashes of all pastes, then its record is
+    compared and decoded.
+    """
+
+    # region constructor and destructor
+    def __init__(self, filename):
+        if sys.byteorder != 'little':
+            logger.error(INVALID_PACK.format(filename))
+            exit(1)
+        self._filename = filename
+        if os.path.getsize(filename) < PACK_HEADER.size:
+            logger.error(INVALID_PACK.format(filename))
+            exit(1)
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index = PACK_HEADER.unpack_from(self._map)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            self._map.close()
+            logger.error(INVALID_PACK.format(filename))
+            exit(1)
+        view = memoryview(self._map)
+        self._hashes = view[index:index+8*count].cast('Q')
+        self._offsets = view[index+8*count:index+16*count].cast('Q')
+        self._lengths = view[index+16*count:index+24*count].cast('I')  # paste, entry
+
+    def __repr__(self):
+        return '{}("{}")'.format(type(self).__name__, self._filename)
+    # endregion
+
+    # region mapping protocol
+    def __len__(self):
+        return len(self._hashes)
+
+    def get(self, paste, default=None):
+        key = paste.encode('utf-8')
+        digest = pack_hash(key)
+        i = bisect.bisect_left(self._hashes, digest)
+        while i < len(self._hashes) and self._hashes[i] == digest:
+            start, key_length = self._offsets[i], self._lengths[2*i]
+            if self._map[start:start+key_length] == key:
+                value = self._map[start+key_length:start+key_length+self._lengths[2*i+1]]
+                return unpack_entry(paste, json.loads(value.decode('utf-8')))
+            i += 1
+        return default
+
+    def items(self):
+        # In the order of the hashes.
+        for i in range(len(self._hashes)):
+            start, key_length, value_length = self._offsets[i], self._lengths[2*i], self._lengths[2*i+1]
+            paste = self._map[start:start+key_length].decode('utf-8')
+            value = self._map[start+key_length:start+key_length+value_length]
+            yield paste, unpack_entry(paste, json.loads(value.decode('utf-8')))
+    # endregion
+
+    # region public functions
+    def close(self):
+        for view in (self._hashes, self._offsets, self._lengths):
+            view.release()
+        self._map.close()
+    # endregion
+
+
+def pack_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def is_pack(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(PACK_MAGIC)) == PACK_MAGIC
+
+
+def write_pack(filepath, items):
+    # Write (paste, entry) pairs as a pack, a later pair replacing an earlier one of the same paste. Return the number
+    # of entries.
+    hashes, offsets, lengths = array.array('Q'), array.array('Q'), array.array('I')
+    with open(filepath, 'w+b') as f:
+        f.write(bytes(PACK_HEADER.size))
+        offset = PACK_HEADER.size
+        for paste, entry in items:
+            key = paste.encode('utf-8')
+            value = json.dumps(pack_entry(paste, entry), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            f.write(key)
+            f.write(value)
+            hashes.append(pack_hash(key))
+            offsets.append(offset)
+            lengths.extend((len(key), len(value)))
+            offset += len(key) + len(value)
+        f.flush()
+        # Sort by hash, the latest record of a paste first as the sort is stable, then keep only that one.
+        order = sorted(range(len(hashes) - 1, -1, -1), key=hashes.__getitem__)
+        kept = []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as records:
+            for i in order:
+                key = records[offsets[i]:offsets[i]+lengths[2*i]]
+                j = len(kept) - 1
+                while j >= 0 and hashes[kept[j]] == hashes[i]:
+                    if records[offsets[kept[j]]:offsets[kept[j]]+lengths[2*kept[j]]] == key:
+                        break
+                    j -= 1
+                else:
+                    kept.append(i)
+        index = offset + -offset % 8
+        f.write(bytes(index - offset))
+        for column in (array.array('Q', (hashes[i] for i in kept)), array.array('Q', (offsets[i] for i in kept)),
+                       array.array('I', (length for i in kept for length in (lengths[2*i], lengths[2*i+1])))):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            f.write(column.tobytes())
+        f.seek(0)
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(kept), index))
+    return len(kept)
+
+
+def build_pack(output, inputs, password=None):
+    # Build a pack from logs of any format and other packs. Later inputs override earlier ones. The pack is written
+    # next to `output` and then moved over it at once, so that `output` may also be an input.
+    sources, temporary = [], output + '.tmp'
+
+    def items():
+        for filepath in inputs:
+            if not os.path.isfile(filepath):
+                logger.error(FILE_NOT_FOUND.format(filepath))
+                exit(1)
+            if is_pack(filepath):
+                source = TranslationPack(filepath)
+            else:
+                source = open_log(filepath, password)
+                if password:
+                    source.check_password()
+            sources.append(source)
+            yield from source.items()
+
+    try:
+        count = write_pack(temporary, items())
+    except BaseException:
+        if os.path.isfile(temporary):
+            os.remove(temporary)
+        raise
+    finally:
+        for source in sources:
+            source.close()
+    os.replace(temporary, output)
+    logger.info(PACK_BUILT.format(count, output))
+# endregion
 # endregion
 
-# region main loop
-def main_loop(profile):
-    paste = pyperclip.paste()
-    tts_thread = None
-    count = 0
-    logger.debug(profile.print_config())
-    logger.info(START_MONITORING)
-    while True:
-        if paste == pyperclip.paste():
-            count += 1
-            logger.debug('[{}] Same paste, continue...'.format(count))
-            time.sleep(profile.interval)
-            continue
-        paste = pyperclip.paste()
+
+# region batch
+def batch(profile, lines, size=32):
+    pastes = list(dict.fromkeys(line.strip() for line in lines if line.strip()))
+    todo, over = [], 0
+    for paste in pastes:
         if len(paste) > profile.number:
-            count = 0
-            logger.info(OVER_CHARACTERS.format(profile.number))
-            time.sleep(profile.interval)
+            over += 1
             continue
-        count = 0
-        logger.debug('A different detected.')
-        # region source
-        print(DIVIDING_TITLE.format('SOURCE'), flush=True)
-        if profile.source == 'ja':
-            source = mecab_wakati.parse(paste).rstrip()
-            print(source, flush=True)  # rstrip() to remove ' \n' at the end.
-        else:
-            source = paste
-            print(source, flush=True)
-        # endregion
-        # region tts
-        if profile.voice:
-            if profile.match and re.search(profile.match, paste) or profile.match is None:
-                logger.debug('"{}" matches in paste. Continue...'.format(profile.match))
-                if tts_thread:
-                    tts_thread.kill()
-                    logger.debug('Previous TTS process killed.')
-                tts_thread = Process(target=youdao_tts, args=(paste, profile.voice, profile.source))
-                tts_thread.start()
-                logger.debug('TTS process starts.')
-            else:
-                logger.debug('"{}" does not match in paste. Pass...'.format(profile.match))
-        # endregion
-        # region romkan
-        if paste in profile.log:
-            print(DIVIDING_TITLE.format('ROMKAN (from log)'), flush=True)
-            print(profile.log[paste]['romkan'], flush=True)
-        elif profile.source == 'ja':
-            print(DIVIDING_TITLE.format('ROMKAN'), flush=True)
-            chasen_list, roma_text = mecab_chasen.parse(paste), ''
-            for line in chasen_list.split('\n'):
-                if line != '' and line != 'EOS':
-                    items = line.split('\t')
-                    roma_text += romkan.to_roma(items[1]) + ' '
-            print(roma_text, flush=True)
-        else:
-            roma_text = None
-        # endregion
-        # region youdao
-        if paste in profile.log and profile.log[paste]['youdao'] is not None:
-            print(DIVIDING_TITLE.format('YOUDAO (from log)'), flush=True)
-            youdao = profile.log[paste]['youdao']
-            print(youdao, flush=True)
-        else:
-            if 'youdao' in profile.disable:
-                logger.info('The "--disable" option is set. Pass youdao translate.')
-                youdao = None
-            else:
-                print(DIVIDING_TITLE.format('YOUDAO'), flush=True)
-                youdao = youdao_translate(paste, target=profile.target[0], source=profile.source)
-                print(youdao, flush=True)
-        # endregion
-        # region aws
-        if paste in profile.log and profile.log[paste]['aws'] is not None:
-            print(DIVIDING_TITLE.format('AWS (from log)'), flush=True)
-            aws = profile.log[paste]['aws']
-            print(aws, flush=True)
-        else:
-            if 'aws' in profile.disable:
-                logger.info('The "--disable" option is set. Pass aws translate.')
-                aws = None
-            else:
-                print(DIVIDING_TITLE.format('AWS'), flush=True)
-                aws = aws_translate(paste, target=profile.target[1], source=profile.source)
-                print(aws, flush=True)
-        # endregion
-        # region google
-        if paste in profile.log and profile.log[paste]['aws'] is not None:
-            print(DIVIDING_TITLE.format('GOOGLE (from log)'), flush=True)
-            google = profile.log[paste]['google']
-            print(google, flush=True)
-        else:
-            if 'google' in profile.disable:
-                logger.info('The "--disable" option is set. Pass google translate.')
-                google = None
+        entry = profile.log.get(paste)
+        if entry is None or any(entry.get(name) is None and name not in profile.disable for name in profile.engines):
+            todo.append(paste)
+    logger.info(BATCH_SKIPPED.format(len(pastes) - len(todo) - over, over, profile.number))
+    executor = ThreadPoolExecutor(max_workers=pool_size)
+    start_time, chars = time.monotonic(), 0
+    for i in range(0, len(todo), size):
+        chunk = todo[i:i+size]
+        results = {paste: profile.log.get(paste) or {} for paste in chunk}
+        futures = {}
+        for name, engine in profile.engines.items():
+            missing = [paste for paste in chunk if results[paste].get(name) is None]
+            if name in profile.disable or not missing:
+                continue
+            if engine.batching:
+                futures[engine.submit(executor, missing)] = (name, missing)
             else:
-                print(DIVIDING_TITLE.format('GOOGLE'), flush=True)
-                google = google_translate(paste)
-                print(google, flush=True)
-        # endregion
-        # region save log (in memory)
-        profile.log[paste] = {}
-        profile.log[paste]['source'] = source
-        profile.log[paste]['romkan'] = roma_text
-        profile.log[paste]['youdao'] = youdao
-        profile.log[paste]['aws'] = aws
-        profile.log[paste]['google'] = google
-        # endregion
-        print(DIVIDING_LINE, flush=True)
+                for paste in missing:
+                    futures[engine.submit(executor, [paste])] = (name, [paste])
+        for future in as_completed(futures):
+            name, pastes = futures[future]
+            for paste, translation in zip(pastes, future.result()):
+                results[paste][name] = translation
+        log = {}
+        for paste in chunk:
+            sentence = tokenize(paste) if profile.source == 'ja' else None
+            log[paste] = dict(results[paste], source=sentence.source if sentence else paste,
+                              romkan=sentence.romkan if sentence else None)
+            for name in profile.engines:
+                log[paste].setdefault(name, None)
+        profile.log.update(log)
+        chars += sum(len(paste) for paste in chunk)
+        logger.info(BATCH_PROGRESS.format(i + len(chunk), len(todo)))
+    period = max(time.monotonic() - start_time, 1e-9)
+    logger.info(BATCH_FINISHED.format(len(todo), chars, period, len(todo) / period, chars / period))
+    executor.shutdown()
 # endregion
 
 
@@ -465,60 +3214,75 @@ def main_loop(profile):
 class Profile:
 
     # region type hints
-    _log: dict
+    _log: LogStore  # Or an EncryptedLogStore.
     _log_filename: str
     # endregion
 
     # region constructor and destructor
-    def __init__(self, section, log, encrypt, voice, match, disable, source, target, interval, agth, opt):
+    def __init__(self, section, log, encrypt, fuzzy, pack, voice, match, disable, number, segment, source, target,
+                 engines, concurrent, timeout, race, hedge, interval, watcher, agth, opt, stream, prefetch, output,
+                 local=True):
         # region overwrite options
         if section:
             if not config.has_section(section):
                 logger.error(SECTION_NOT_FOUND.format(section))
                 exit(1)
-            log = config.get(section, 'log', fallback=section+'.json')
+            log = config.get(section, 'log', fallback=section+LOG_STORE_EXT)
             encrypt = config.get(section, 'encrypt', fallback=None)
+            fuzzy = config.getfloat(section, 'fuzzy', fallback=0.0)
+            pack = config.get(section, 'pack', fallback='')
             voice = config.get(section, 'voice', fallback=None)
             match = config.get(section, 'match', fallback=None)
             disable = config.get(section, 'disable', fallback='')
             number = config.getint(section, 'number', fallback=256)
+            segment = config.getboolean(section, 'segment', fallback=False)
             source = config.get(section, 'source', fallback='ja')
             target = config.get(section, 'target', fallback='zh-CHS,en,zh-CN')
+            engines = config.get(section, 'engines', fallback=','.join(ENGINES))
+            concurrent = config.getboolean(section, 'concurrent', fallback=False)
+            timeout = config.getfloat(section, 'timeout', fallback=10.0)
+            race = config.getboolean(section, 'race', fallback=False)
+            hedge = config.getboolean(section, 'hedge', fallback=False)
             interval = config.getfloat(section, 'interval', fallback=1.0)
+            watcher = config.get(section, 'watcher', fallback='auto')
             agth = config.get(section, 'agth', fallback=None)
             opt = config.get(section, 'opt', fallback='')
+            stream = config.get(section, 'stream', fallback=None)
+            prefetch = config.getint(section, 'prefetch', fallback=5)
+            output = config.get(section, 'output', fallback='terminal')
         else:
             self._section = DEFAULT_SECTION
+        if not local:
+            # A profile of the daemon neither speaks nor hooks text, its clients do, whatever its section says.
+            voice, agth, stream = None, None, None
         # endregion
         # region init log, encrypt
         self._encrypt = encrypt
-        if log and not os.path.isfile(log):
-            logger.info(CREATE_A_NOT_EXISTS_FILE.format(log))
-            self._log_filename = log
-            self._log = {}
-        elif log:
-            self._log_filename = log
-            if encrypt:
-                with open(log, 'rb') as f:
-                    try:
-                        self._log = json.loads(decrypt(f.read(), encrypt))
-                    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                        logger.error(WRONG_PASSWORD.format(log))
-                        exit(1)
-            else:
-                with open(log, 'r') as f:
-                    try:
-                        self._log = json.loads(f.read())
-                    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                        logger.error(PASSWORD_NOT_SPECIFIED.format(log))
-                        exit(1)
+        log = log or DEFAULT_SECTION + LOG_STORE_EXT
+        self._log_filename = log_store_filename(log)
+        if not 0 <= fuzzy <= 1:
+            logger.error('--fuzzy option "{}" is not between 0 and 1.'.format(fuzzy))
+            exit(1)
+        self._fuzzy = fuzzy
+        if encrypt:
+            self._log = EncryptedLogStore(self._log_filename, encrypt, fuzzy > 0)
         else:
-            self._log_filename = DEFAULT_SECTION + '.json'
-            if os.path.exists(self._log_filename):
-                with open(self._log_filename, 'r+') as f:
-                    self._log = json.loads(f.read())
+            self._log = LogStore(self._log_filename, fuzzy > 0)
+        # Migrate a legacy ".json" or whole-file encrypted log once, the original file is kept.
+        legacy = log if log != self._log_filename else rename_ext(log, '.json')
+        if not os.path.isfile(self._log_filename):
+            if os.path.isfile(legacy):
+                self._log.migrate(legacy)
             else:
-                self._log = {}
+                logger.info(CREATE_A_NOT_EXISTS_FILE.format(self._log_filename))
+        if encrypt:
+            self._log.check_password()
+        self._pack = tuple(filepath for filepath in pack.split(',') if filepath)
+        for filepath in self._pack:
+            if not os.path.isfile(filepath):
+                logger.error(FILE_NOT_FOUND.format(filepath))
+                exit(1)
+            self._log.attach(TranslationPack(filepath))
         # endregion
         # region init tts, voice
         if voice and voice not in ('0', '1'):
@@ -527,32 +3291,75 @@ class Profile:
         self._match = match
         # endregion
         # region init disable, number, source, target
-        self._disable = disable
+        self._disable = tuple(engine for engine in disable.split(',') if engine)
+        for engine in self._disable:
+            if engine not in ENGINE_CLASSES:
+                logger.error('--disable option "{}" is not a translate engine.'.format(engine))
+                exit(1)
         self._number = number
+        self._segment = segment
         if source not in SOURCE_ALL:
             logger.error('--source option "{}" is not supported.'.format(source))
             exit(1)
+        self._source = source
+        # endregion
+        # region init engines, target
+        names = [name for name in engines.split(',') if name]
         targets = target.split(',')
-        if len(targets) != 3:
-            logger.error('--target option "{}" format error.'.format(target))
-            exit(1)
-        if targets[0] not in TARGET_YOUDAO:
-            logger.error('--target option "{}" not supported by youdao.'.format(targets[0]))
-            exit(1)
-        if targets[1] not in TARGET_AWS:
-            logger.error('--target option "{}" not supported by aws.'.format(targets[1]))
+        if len(targets) != len(names):
+            logger.error('--target option "{}" format error. One for each of "{}".'.format(target, engines))
             exit(1)
-        self._source = source
-        self._target = (targets[0], targets[1], )
+        options = dict(config['global'])
+        if section:
+            options.update(config[section])
+        self._engines = OrderedDict()
+        for name, code in zip(names, targets):
+            if name not in ENGINE_CLASSES:
+                logger.error('--engines option "{}" is not a translate engine.'.format(name))
+                exit(1)
+            engine_class = ENGINE_CLASSES[name]
+            if engine_class.targets is not None and code not in engine_class.targets:
+                logger.error('--target option "{}" not supported by {}.'.format(code, name))
+                exit(1)
+            self._engines[name] = engine_class(code, source, options)
+        self._target = tuple(targets)
         # endregion
-        # region init interval, agth, opt
+        # region init concurrent, timeout, race, hedge
+        self._concurrent = concurrent
+        self._timeout = timeout
+        self._race = race
+        self._hedge = hedge
+        # endregion
+        # region init limits
+        # Per section limits fall back to the [global] section, 0 means unlimited.
+        limits_section = section if section else 'global'
+        self._limits = {}
+        for engine in list(self._engines) + ['tts']:
+            self._limits[engine] = tuple(
+                config.getfloat(limits_section, engine+suffix, fallback=config.getfloat('global', engine+suffix,
+                                                                                        fallback=0))
+                for suffix in ('_rps', '_cps', '_monthly'))
+        # endregion
+        # region init interval, watcher, agth, opt
         self._interval = interval
+        if watcher not in WATCHERS:
+            logger.error('--watcher option "{}" is not supported.'.format(watcher))
+            exit(1)
+        self._watcher = watcher
         self._agth = agth
         self._opt = opt if opt else ''
+        self._stream = stream
+        self._prefetch = prefetch
+        self._output = output
+        self._agth_process = None
+        if stream == 'agth' and not agth:
+            logger.error('--stream option "agth" needs --agth option.')
+            exit(1)
         if self._agth:
             cmd = agth + opt
             logger.info(START_AGTH_FROM.format(agth, opt))
-            subprocess.Popen([agth]+opt.split(' '))
+            self._agth_process = subprocess.Popen([agth]+opt.split(' '),
+                                                  stdout=subprocess.PIPE if stream == 'agth' else None)
         # endregion
     # endregion
 
@@ -592,6 +3399,22 @@ class Profile:
     def encrypt(self, value):
         logger.warning(ACCESS_READONLY_PROPERTY.format('encrypt'))
 
+    @property
+    def fuzzy(self):
+        return self._fuzzy
+
+    @fuzzy.setter
+    def fuzzy(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('fuzzy'))
+
+    @property
+    def pack(self):
+        return self._pack
+
+    @pack.setter
+    def pack(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('pack'))
+
     @property
     def voice(self):
         return self._voice
@@ -624,6 +3447,14 @@ class Profile:
     def number(self, value):
         logger.warning(ACCESS_READONLY_PROPERTY.format('number'))
 
+    @property
+    def segment(self):
+        return self._segment
+
+    @segment.setter
+    def segment(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('segment'))
+
     @property
     def source(self):
         return self._source
@@ -640,6 +3471,54 @@ class Profile:
     def target(self, value):
         logger.warning(ACCESS_READONLY_PROPERTY.format('target'))
 
+    @property
+    def engines(self):
+        return self._engines
+
+    @engines.setter
+    def engines(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('engines'))
+
+    @property
+    def concurrent(self):
+        return self._concurrent
+
+    @concurrent.setter
+    def concurrent(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('concurrent'))
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('timeout'))
+
+    @property
+    def race(self):
+        return self._race
+
+    @race.setter
+    def race(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('race'))
+
+    @property
+    def hedge(self):
+        return self._hedge
+
+    @hedge.setter
+    def hedge(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('hedge'))
+
+    @property
+    def limits(self):
+        return self._limits
+
+    @limits.setter
+    def limits(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('limits'))
+
     @property
     def interval(self):
         return self._interval
@@ -648,6 +3527,14 @@ class Profile:
     def interval(self, value):
         logger.warning(ACCESS_READONLY_PROPERTY.format('interval'))
 
+    @property
+    def watcher(self):
+        return self._watcher
+
+    @watcher.setter
+    def watcher(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('watcher'))
+
     @property
     def agth(self):
         return self._agth
@@ -663,6 +3550,38 @@ class Profile:
     @opt.setter
     def opt(self, value):
         logger.warning(ACCESS_READONLY_PROPERTY.format('opt'))
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @stream.setter
+    def stream(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('stream'))
+
+    @property
+    def prefetch(self):
+        return self._prefetch
+
+    @prefetch.setter
+    def prefetch(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('prefetch'))
+
+    @property
+    def output(self):
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('output'))
+
+    @property
+    def agth_process(self):
+        return self._agth_process
+
+    @agth_process.setter
+    def agth_process(self, value):
+        logger.warning(ACCESS_READONLY_PROPERTY.format('agth_process'))
     # endregion
 
     # region public functions
@@ -670,46 +3589,150 @@ class Profile:
         # if self._disable:
         #     logger.info(LOG_WONT_BE_SAVED)
         #     return
-        if self._encrypt:
-            with open(self._log_filename, 'wb') as f:
-                f.write(encrypt(json.dumps(self._log), self.encrypt))
-        else:
-            with open(self._log_filename, 'w') as f:
-                f.write(json.dumps(self._log))
+        self._log.close()  # Entries have been written as they were produced.
 
     def print_config(self):
         return """
         log = {}
         encrypt = {}
+        fuzzy = {}
+        pack = {}
         voice = {}
         match = {}
         disable = {}
         number = {}
+        segment = {}
         source = {}
         target = {}
+        engines = {}
+        concurrent = {}
+        timeout = {}
+        race = {}
+        hedge = {}
+        limits = {}
         interval = {}
+        watcher = {}
         agth = {}
         opt = {}
-        """.format(self.log, self.encrypt, self.voice, self.match, self.disable, self.number, self.source, self.target,
-                   self.interval, self.agth, self.opt)
+        stream = {}
+        prefetch = {}
+        output = {}
+        """.format(self.log, self.encrypt, self.fuzzy, ','.join(self.pack), self.voice, self.match, self.disable,
+                   self.number, self.segment, self.source, self.target, ','.join(self.engines), self.concurrent,
+                   self.timeout, self.race, self.hedge, self.limits, self.interval, self.watcher, self.agth, self.opt,
+                   self.stream, self.prefetch, self.output)
     # endregion
 # endregion
 
 
 # region main
+def create_profile(args, configure=True, local=True):
+    profile = Profile(args.profile, args.log, args.encrypt, args.fuzzy, args.pack, args.voice, args.match, args.disable,
+                      args.number, args.segment, args.source, args.target, args.engines, args.concurrent, args.timeout,
+                      args.race, args.hedge, args.interval, args.watcher, args.agth, args.opt, args.stream,
+                      args.prefetch, args.output, local)
+    if configure:
+        scheduler.configure(profile.limits)
+    return profile
+
+
+def log_usage():
+    for engine, usage in scheduler.usage().items():
+        if usage['requests'] or usage['dropped']:
+            logger.info(BUDGET_USAGE.format(engine, usage['requests'], usage['chars'], usage['dropped'],
+                                            usage['monthly_chars'], usage['monthly_limit'] or '-'))
+
+
+def serve(args, dump_metrics=None):
+    daemon = Daemon(args)
+    warm_up(daemon.profile({}))
+    server = create_daemon_server(daemon, args.host, args.port, args.socket)
+    logger.info(DAEMON_LISTENING.format('unix:'+args.socket if args.socket else
+                                        'http://{}:{}'.format(*server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
+        daemon.close()
+        log_usage()
+        if dump_metrics:
+            dump_metrics()
+        logger.info(DONE)
+
+
 def main():
+    dump_metrics = export_metrics(metrics_file, metrics_interval) if metrics_file else None
+    if sys.argv[1:2] == ['pack']:
+        args = pack_parser.parse_args(sys.argv[2:])
+        build_pack(args.output, args.inputs, args.encrypt)
+        exit(0)
+    if sys.argv[1:2] == ['serve']:
+        serve(serve_parser.parse_args(sys.argv[2:]), dump_metrics)
+        exit(0)
+    if sys.argv[1:2] == ['batch']:
+        args = batch_parser.parse_args(sys.argv[2:])
+        if args.connect:
+            f = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf8')
+            with f:
+                lines = [line.strip() for line in f if line.strip()]
+            body = dict(daemon_settings(args), texts=lines, batch_size=args.batch_size)
+            with daemon_request(args.connect, '/batch', body) as response:
+                result = json.loads(response.read().decode('utf-8'))
+            if response.status != 200:
+                logger.error(result['error'])
+                exit(1)
+            logger.info(DONE)
+            exit(0)
+        profile = create_profile(args)
+        if args.input == '-':
+            batch(profile, sys.stdin, args.batch_size)
+        else:
+            with open(args.input, 'r', encoding='utf8') as f:
+                batch(profile, f, args.batch_size)
+        logger.info(SAVING_TO_PLEASE_WAIT.format(profile.log_filename))
+        profile.save_log()
+        log_usage()
+        if dump_metrics:
+            dump_metrics()
+        logger.info(DONE)
+        exit(0)
     args = parser.parse_args(sys.argv[1:])
     if args.passwd:
         passwd(args.passwd)
         exit(0)
-    profile = Profile(args.profile, args.log, args.encrypt, args.voice, args.match,
-                      args.disable, args.source, args.target, args.interval, args.agth, args.opt)
+    if args.connect:
+        renderer = create_renderer(args.output)
+        try:
+            client_loop(args, args.connect, tts_worker=TTSWorker() if args.voice else None, renderer=renderer)
+        except KeyboardInterrupt:
+            renderer.close()
+            logger.info(DONE)
+        exit(0)
+    profile = create_profile(args)
+    warm_up(profile)
+    tts_worker = TTSWorker() if profile.voice else None
+    prefetcher = None
+    if profile.stream:
+        f, follow = open_stream(profile)
+        prefetcher = Prefetcher(profile, f, follow, profile.prefetch, tts_worker)
+    renderer = create_renderer(profile.output)
     try:
-        main_loop(profile)
+        main_loop(profile, tts_worker=tts_worker, prefetcher=prefetcher, renderer=renderer)
     except KeyboardInterrupt:
+        renderer.close()
         logger.info(SAVING_TO_PLEASE_WAIT.format(profile.log_filename))
         profile.save_log()  # save log in disk.
+        log_usage()
+        if dump_metrics:
+            dump_metrics()
         logger.info(DONE)
+        logger.debug('Sentence cache: {}'.format(sentence_cache.stats()))
+        logger.debug('Romaji cache: {}'.format(roma_cache.stats()))
+        logger.debug('Log: {}'.format(profile.log.stats()))
+        if tts_worker:
+            logger.debug('TTS: {}'.format(tts_worker.stats()))
 # endregion
 
 
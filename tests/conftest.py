@@ -0,0 +1,17 @@
+"""
+cp2trans is imported as the benchmarks do, so "cp2trans/config.ini" must exist.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv[1:] = []  # cp2trans parses the command line when imported.
+from cp2trans import cp2trans  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fast_kdf(monkeypatch):
+    # Keys are derived as they are at run time, only in fewer iterations.
+    monkeypatch.setattr(cp2trans, 'LOG_KDF_ITERATIONS', 1000)
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+
+import pytest
+
+from cp2trans import cp2trans
+
+ENTRIES = {
+    '猫です': {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫', 'google': None},
+    '今日は晴れ。': {'source': '今日 は 晴れ 。', 'romkan': 'kyou ha hare 。', 'aws': "It's sunny today."},
+    'hello world': {'source': 'hello world', 'romkan': None, 'youdao': '你好世界'},
+}
+
+
+def saved(entry):
+    # Entries are read back without the translations which are missing.
+    return {name: value for name, value in entry.items() if value is not None or name == 'romkan'}
+
+
+def write(log, entries):
+    for paste, entry in entries.items():
+        log[paste] = entry
+    log.close()
+
+
+def test_encrypted_log_reopens(tmp_path):
+    filename = str(tmp_path / 'default.db')
+    write(cp2trans.EncryptedLogStore(filename, 'secret'), ENTRIES)
+    log = cp2trans.EncryptedLogStore(filename, 'secret')
+    log.check_password()
+    assert dict(log.items()) == {paste: saved(entry) for paste, entry in ENTRIES.items()}
+    assert log.get('猫です') == saved(ENTRIES['猫です'])
+    assert log.get('犬です') is None
+    assert len(log) == len(ENTRIES)
+    log.close()
+
+
+def test_encrypted_log_hides_pastes(tmp_path):
+    filename = str(tmp_path / 'default.db')
+    write(cp2trans.EncryptedLogStore(filename, 'secret'), ENTRIES)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for paste in ENTRIES:
+        assert paste.encode('utf-8') not in data
+
+
+def test_encrypted_log_rejects_wrong_password(tmp_path):
+    filename = str(tmp_path / 'default.db')
+    write(cp2trans.EncryptedLogStore(filename, 'secret'), ENTRIES)
+    log = cp2trans.EncryptedLogStore(filename, 'wrong')
+    with pytest.raises(SystemExit):
+        log.check_password()
+
+
+def test_encrypted_log_rejects_tampered_record(tmp_path):
+    filename = str(tmp_path / 'default.db')
+    write(cp2trans.EncryptedLogStore(filename, 'secret'), ENTRIES)
+    connection = sqlite3.connect(filename)
+    key, value = connection.execute('SELECT paste, entry FROM log LIMIT 1').fetchone()
+    connection.execute('UPDATE log SET entry = ? WHERE paste = ?', (value[:-1] + bytes([value[-1] ^ 1]), key))
+    connection.commit()
+    connection.close()
+    log = cp2trans.EncryptedLogStore(filename, 'secret')
+    with pytest.raises(SystemExit):
+        dict(log.items())
+
+
+def test_plain_log_is_not_opened_encrypted(tmp_path):
+    filename = str(tmp_path / 'default.db')
+    write(cp2trans.LogStore(filename), ENTRIES)
+    log = cp2trans.EncryptedLogStore(filename, 'secret')
+    with pytest.raises(SystemExit):
+        log.check_password()
+
+
+@pytest.mark.parametrize('target, old_password, new_password', [
+    ('C', 'secret', 'changed'),
+    ('E', None, 'secret'),
+    ('D', 'secret', None),
+])
+def test_passwd(tmp_path, monkeypatch, target, old_password, new_password):
+    filename = str(tmp_path / 'default.db')
+    old_log = cp2trans.EncryptedLogStore(filename, old_password) if old_password else cp2trans.LogStore(filename)
+    write(old_log, ENTRIES)
+    passwords = iter(password for password in (old_password, new_password) if password)
+    monkeypatch.setattr('builtins.input', lambda prompt='': target)
+    monkeypatch.setattr(cp2trans.getpass, 'getpass', lambda prompt='': next(passwords))
+    cp2trans.passwd(filename)
+    new_filename = str(tmp_path / ('default(decrypted).db' if target == 'D' else 'default(encrypted).db'))
+    if new_password:
+        new_log = cp2trans.EncryptedLogStore(new_filename, new_password)
+        new_log.check_password()
+        with pytest.raises(SystemExit):
+            cp2trans.EncryptedLogStore(new_filename, old_password or 'wrong').check_password()
+    else:
+        new_log = cp2trans.LogStore(new_filename)
+    assert dict(new_log.items()) == {paste: saved(entry) for paste, entry in ENTRIES.items()}
+    new_log.close()
+    # The original log is kept as it is.
+    old_log = cp2trans.open_log(filename, old_password)
+    assert len(old_log) == len(ENTRIES)
+    old_log.close()
+
+
+def test_migrate_json_log(tmp_path):
+    legacy = tmp_path / 'default.json'
+    legacy.write_text(json.dumps(ENTRIES, ensure_ascii=False), encoding='utf-8')
+    log = cp2trans.open_log(str(legacy))
+    assert dict(log.items()) == {paste: saved(entry) for paste, entry in ENTRIES.items()}
+    log.close()
+
+
+def test_migrate_broken_json_log(tmp_path):
+    legacy = tmp_path / 'default.json'
+    legacy.write_bytes(b'\x93\x00 not json')
+    with pytest.raises(SystemExit):
+        cp2trans.open_log(str(legacy))
+
+
+def encrypt_legacy(text, password):
+    # The whole-file AES-ECB format of older versions.
+    from Crypto.Cipher import AES
+    return AES.new(cp2trans.align(password), AES.MODE_ECB).encrypt(cp2trans.align(text.encode('utf-8')))
+
+
+def test_migrate_ecb_log(tmp_path):
+    legacy = tmp_path / 'default.json'
+    legacy.write_bytes(encrypt_legacy(json.dumps(ENTRIES, ensure_ascii=False), 'secret'))
+    log = cp2trans.open_log(str(legacy), 'secret')
+    assert isinstance(log, cp2trans.EncryptedLogStore)
+    assert dict(log.items()) == {paste: saved(entry) for paste, entry in ENTRIES.items()}
+    log.close()
+
+
+def test_migrate_ecb_log_with_wrong_password(tmp_path):
+    legacy = tmp_path / 'default.json'
+    legacy.write_bytes(encrypt_legacy(json.dumps(ENTRIES, ensure_ascii=False), 'secret'))
+    with pytest.raises(SystemExit):
+        cp2trans.open_log(str(legacy), 'wrong')
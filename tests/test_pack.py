@@ -0,0 +1,114 @@
+import pytest
+
+from cp2trans import cp2trans
+
+ENTRIES = [
+    ('猫です', {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫'}),
+    ('犬です', {'source': '犬 です', 'romkan': 'inu desu', 'google': 'It is a dog.'}),
+    ('今日は晴れ。', {'source': '今日 は 晴れ 。', 'romkan': 'kyou ha hare 。', 'aws': "It's sunny today."}),
+    ('hello world', {'source': 'hello world', 'romkan': None, 'youdao': '你好世界'}),
+]
+
+
+@pytest.mark.parametrize('paste, entry', [
+    ('猫です', {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫'}),
+    ('猫', {'source': '猫', 'romkan': 'neko', 'youdao': '猫'}),
+    ('hello world', {'source': 'hello world', 'romkan': None, 'youdao': '你好世界'}),
+    ('猫です', {'source': '猫  です', 'romkan': 'neko desu'}),
+    ('猫です', {'source': ' 猫 です', 'romkan': 'neko desu'}),
+    ('ねこです', {'source': '猫 です', 'romkan': 'neko desu'}),
+    ('', {'source': '', 'romkan': ''}),
+])
+def test_pack_entry_round_trip(paste, entry):
+    assert cp2trans.unpack_entry(paste, cp2trans.pack_entry(paste, entry)) == entry
+
+
+def test_pack_entry_stores_offsets():
+    assert cp2trans.pack_entry('今日は晴れ。', {'source': '今日 は 晴れ 。', 'romkan': 'kyou ha hare 。'}) == \
+        [[2, 3, 5], 'kyou ha hare 。', {}]
+
+
+def test_pack_entry_drops_missing_translations():
+    entry = {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫', 'google': None}
+    assert cp2trans.unpack_entry('猫です', cp2trans.pack_entry('猫です', entry)) == \
+        {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫'}
+
+
+def test_unpack_legacy_entry():
+    # Entries of older versions are kept as they are.
+    entry = {'youdao': '是猫'}
+    assert cp2trans.pack_entry('猫です', entry) == entry
+    assert cp2trans.unpack_entry('猫です', entry) == entry
+
+
+def read(filename):
+    pack = cp2trans.TranslationPack(filename)
+    try:
+        return len(pack), dict(pack.items()), {paste: pack.get(paste) for paste, _ in ENTRIES}
+    finally:
+        pack.close()
+
+
+def test_write_pack(tmp_path):
+    filename = str(tmp_path / 'default.pack')
+    assert cp2trans.write_pack(filename, ENTRIES) == len(ENTRIES)
+    assert cp2trans.is_pack(filename)
+    count, items, found = read(filename)
+    assert count == len(ENTRIES)
+    assert items == found == dict(ENTRIES)
+    pack = cp2trans.TranslationPack(filename)
+    assert pack.get('鳥です') is None
+    assert pack.get('鳥です', {}) == {}
+    pack.close()
+
+
+def test_write_empty_pack(tmp_path):
+    filename = str(tmp_path / 'default.pack')
+    assert cp2trans.write_pack(filename, []) == 0
+    pack = cp2trans.TranslationPack(filename)
+    assert len(pack) == 0
+    assert pack.get('猫です') is None
+    pack.close()
+
+
+def test_write_pack_keeps_latest_duplicate(tmp_path):
+    filename = str(tmp_path / 'default.pack')
+    latest = {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '是猫', 'google': "It's a cat."}
+    assert cp2trans.write_pack(filename, ENTRIES + [('猫です', latest)] + ENTRIES[1:]) == len(ENTRIES)
+    count, items, found = read(filename)
+    assert count == len(ENTRIES)
+    assert items == found == dict(ENTRIES, 猫です=latest)
+
+
+@pytest.mark.parametrize('pack_hash', [lambda key: 0, lambda key: len(key) % 2])
+def test_write_pack_with_hash_collisions(tmp_path, monkeypatch, pack_hash):
+    monkeypatch.setattr(cp2trans, 'pack_hash', pack_hash)
+    filename = str(tmp_path / 'default.pack')
+    latest = {'source': '犬 です', 'romkan': 'inu desu', 'youdao': '是狗'}
+    assert cp2trans.write_pack(filename, ENTRIES + [('犬です', latest)]) == len(ENTRIES)
+    count, items, found = read(filename)
+    assert count == len(ENTRIES)
+    assert items == found == dict(ENTRIES, 犬です=latest)
+    pack = cp2trans.TranslationPack(filename)
+    assert pack.get('鳥です') is None
+    pack.close()
+
+
+def test_pack_under_log(tmp_path):
+    filename = str(tmp_path / 'default.pack')
+    cp2trans.write_pack(filename, ENTRIES)
+    log = cp2trans.LogStore(str(tmp_path / 'default.db'))
+    log.attach(cp2trans.TranslationPack(filename))
+    own = {'source': '猫 です', 'romkan': 'neko desu', 'youdao': '猫哦'}
+    log['猫です'] = own
+    assert log.get('猫です') == own
+    assert log.get('犬です') == dict(ENTRIES)['犬です']
+    assert dict(log.items()) == {'猫です': own}
+    log.close()
+
+
+def test_invalid_pack(tmp_path):
+    filename = tmp_path / 'default.pack'
+    filename.write_bytes(b'not a pack, only some bytes')
+    with pytest.raises(SystemExit):
+        cp2trans.TranslationPack(str(filename))